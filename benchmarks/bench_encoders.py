@@ -0,0 +1,62 @@
+"""Compare the animated-output encoder backends per output format.
+
+Renders a synthetic Lottie animation once, then feeds the same frames to every
+available backend and reports wall time and output size.
+
+    python benchmarks/bench_encoders.py --size 512 --frames 180 --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from tgs_converter.conversions import load_animation, render_frame  # noqa: E402
+from tgs_converter.encoders import ENCODERS  # noqa: E402
+
+from corpus import synthetic_tgs  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--frames", type=int, default=180)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--formats", default="gif,webm,mp4")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    animation = load_animation(synthetic_tgs(args.frames))
+    fps = animation.lottie_animation_get_framerate()
+    frames = [render_frame(animation, i, args.size, args.size) for i in range(args.frames)]
+
+    for out_format in args.formats.split(","):
+        for encoder in ENCODERS.values():
+            if out_format not in encoder.formats or not encoder.available():
+                continue
+            timings = []
+            size = 0
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                size = sum(len(chunk) for chunk in encoder.encode(
+                    iter(frames), out_format, args.size, args.size, fps, len(frames)))
+                timings.append(time.perf_counter() - started)
+            result = {
+                "format": out_format,
+                "backend": encoder.name,
+                "median_ms": round(statistics.median(timings) * 1000, 2),
+                "min_ms": round(min(timings) * 1000, 2),
+                "bytes": size,
+            }
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{out_format:5} {encoder.name:7} median {result['median_ms']:9.2f} ms  "
+                      f"min {result['min_ms']:9.2f} ms  {size:>9} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""End-to-end GetSticker benchmark against a local Telegram stand-in.
+
+Starts the real servicer on a loopback gRPC port, backed by ``FakeBot`` serving
+the synthetic corpus, and drives it with a gRPC client at each concurrency
+level. For every input/output pair it records latency and time-to-first-byte
+percentiles, throughput, and the time spent per request stage as recorded by
+the servicer's stage metrics. Stages that run inside the engine's worker
+processes are only seen as the enclosing "convert" stage.
+
+    python benchmarks/bench_grpc.py --concurrency 1,8,32 --requests 64 --output before.json
+    python benchmarks/compare.py before.json after.json
+
+Result, raw-file and parsed-animation caches are disabled unless ``--warm`` is
+given, and every request uses a fresh file id so single-flight never coalesces
+them.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+
+STAGES = ["get_file", "download", "parse", "render", "encode", "convert", "stream"]
+
+DEFAULT_PAIRS = [
+    "tgs-simple:gif", "tgs-simple:webm", "tgs-simple:mp4", "tgs-simple:png",
+    "tgs-medium:webm", "tgs-complex:webm",
+    "webm-1s:webm", "webm-1s:gif", "webm-3s:mp4",
+    "png:webp", "webp:png",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50": round(percentile(values, 50) * 1000, 3),
+        "p99": round(percentile(values, 99) * 1000, 3),
+        "mean": round(statistics.fmean(values) * 1000, 3) if values else 0.0,
+    }
+
+
+def stage_snapshots(processor: str, out_format: str) -> Dict[str, List[float]]:
+    from tgs_converter.metrics import STAGE_DURATION
+
+    return {stage: STAGE_DURATION.snapshot(stage=stage, processor=processor, format=out_format) for stage in STAGES}
+
+
+def summarize_stages(before: Dict[str, List[float]], after: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    """Per-stage timings between two snapshots; percentiles are histogram bucket upper bounds."""
+    from tgs_converter.metrics import STAGE_DURATION
+
+    bounds = list(STAGE_DURATION.buckets) + [float("inf")]
+    stages = {}
+    for stage in STAGES:
+        delta = [b - a for a, b in zip(before[stage], after[stage])]
+        counts, total, count = delta[:-2], delta[-2], delta[-1]
+        if not count:
+            continue
+
+        def bucket_percentile(q: float) -> float:
+            seen = 0.0
+            for bound, bucket in zip(bounds, counts):
+                seen += bucket
+                if seen >= q / 100 * count:
+                    return bound
+            return bounds[-1]
+
+        stages[stage] = {
+            "p50": round(bucket_percentile(50) * 1000, 3),
+            "p99": round(bucket_percentile(99) * 1000, 3),
+            "mean": round(total / count * 1000, 3),
+        }
+    return stages
+
+
+async def run_pair(stub, item, out_format: str, concurrency: int, requests: int, size: int, run_id: str):
+    import grpc
+    from generated.telegram_stickers_converter.telegram_stickers_converter_pb2 import GetStickerRequest
+    from tgs_converter.server import OUTPUT_FORMAT_PROTO_MAP
+
+    processor = "animated" if item.is_animated else "video" if item.is_video else "static"
+    stages_before = stage_snapshots(processor, out_format)
+    latencies, ttfbs = [], []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for n in counter:
+            request = GetStickerRequest(
+                sticker_file_id=f"{item.name}#{run_id}-{out_format}-{concurrency}-{n}",
+                is_animated=item.is_animated,
+                is_video=item.is_video,
+                desired_format=OUTPUT_FORMAT_PROTO_MAP[out_format],
+                width=size,
+                height=size,
+            )
+            started = time.perf_counter()
+            first_byte = None
+            received = 0
+            call = stub.GetSticker(request)
+            try:
+                async for chunk in call:
+                    if chunk.data_chunk:
+                        if first_byte is None:
+                            first_byte = time.perf_counter()
+                        received += len(chunk.data_chunk)
+                if await call.code() != grpc.StatusCode.OK or not received:
+                    errors += 1
+                    continue
+            except Exception:
+                errors += 1
+                continue
+            finished = time.perf_counter()
+            latencies.append(finished - started)
+            ttfbs.append(first_byte - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    return {
+        "input": item.name,
+        "output": out_format,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else 0.0,
+        "latency_ms": summarize(latencies),
+        "ttfb_ms": summarize(ttfbs),
+        "stages_ms": summarize_stages(stages_before, stage_snapshots(processor, out_format)),
+    }
+
+
+async def main_async(args):
+    import grpc
+    from generated.telegram_stickers_converter.telegram_stickers_converter_pb2_grpc import (
+        StickerConverterServiceStub, add_StickerConverterServiceServicer_to_server)
+    from tgs_converter.bot import TelegramDownloader
+    from tgs_converter.engine import engine
+    from tgs_converter.server import TelegramStickersConverterServicer
+
+    from corpus import build_corpus
+    from fake_bot import FakeBot
+
+    pairs = [pair.split(":", 1) for pair in args.pairs.split(",")]
+    corpus = build_corpus(include_video=any(name.startswith("webm") for name, _ in pairs))
+    bot = FakeBot(corpus, api_latency=args.api_latency / 1000, download_latency=args.download_latency / 1000)
+    downloader = TelegramDownloader(bot, file_info_ttl=3000, file_info_entries=100000,
+                                    raw_cache_bytes=(128 * 2 ** 20) if args.warm else 0)
+
+    server = grpc.aio.server()
+    add_StickerConverterServiceServicer_to_server(TelegramStickersConverterServicer(downloader=downloader), server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    await server.start()
+
+    results = []
+    run_id = str(int(time.time()))
+    try:
+        async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+            stub = StickerConverterServiceStub(channel)
+            # One untimed request per pair pays the worker-pool spawn and codec start-up costs.
+            for name, out_format in pairs:
+                await run_pair(stub, corpus[name], out_format, 1, 1, args.size, f"{run_id}-warmup")
+            for name, out_format in pairs:
+                for concurrency in (int(c) for c in args.concurrency.split(",")):
+                    result = await run_pair(stub, corpus[name], out_format, concurrency,
+                                            args.requests, args.size, run_id)
+                    results.append(result)
+                    print(f"{name:12} -> {out_format:5} c={concurrency:<3} "
+                          f"p50 {result['latency_ms']['p50']:9.2f} ms  p99 {result['latency_ms']['p99']:9.2f} ms  "
+                          f"ttfb p50 {result['ttfb_ms']['p50']:8.2f} ms  {result['throughput_rps']:8.2f} rps  "
+                          f"errors {result['errors']}", flush=True)
+    finally:
+        await server.stop(None)
+        engine.shutdown(wait=False)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", default=",".join(DEFAULT_PAIRS),
+                        help="comma-separated <corpus item>:<output format> pairs")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--requests", type=int, default=32, help="requests per pair and concurrency level")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency, ms")
+    parser.add_argument("--download-latency", type=float, default=0.0, help="simulated download latency, ms")
+    parser.add_argument("--warm", action="store_true", help="keep the result and raw-file caches enabled")
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    args = parser.parse_args()
+
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+    if not args.warm:
+        os.environ["RESULT_CACHE_MEMORY_BYTES"] = "0"
+        os.environ.pop("RESULT_CACHE_DIR", None)
+        # Every fresh file id carries the same content, so parses would all be cache hits.
+        os.environ["ANIMATION_CACHE_ENTRIES"] = "0"
+
+    report = asyncio.run(main_async(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
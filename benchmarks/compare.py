@@ -0,0 +1,44 @@
+"""Compare two bench_grpc.py result files.
+
+    python benchmarks/compare.py before.json after.json
+
+Prints p50/p99 latency, time-to-first-byte and throughput for every
+input/output/concurrency combination present in both files, with the relative
+change; negative latency and positive throughput changes are improvements.
+"""
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        report = json.load(f)
+    return {(r["input"], r["output"], r["concurrency"]): r for r in report["results"]}
+
+
+def change(before: float, after: float) -> str:
+    if not before:
+        return "    n/a"
+    return f"{(after - before) / before * 100:+6.1f}%"
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(2)
+    before, after = load(sys.argv[1]), load(sys.argv[2])
+    print(f"{'input':12} {'output':6} {'c':>3}  {'p50 ms':>18}  {'p99 ms':>18}  {'ttfb p50 ms':>18}  {'rps':>18}")
+    for key in sorted(before.keys() & after.keys()):
+        b, a = before[key], after[key]
+        columns = [
+            (b["latency_ms"]["p50"], a["latency_ms"]["p50"]),
+            (b["latency_ms"]["p99"], a["latency_ms"]["p99"]),
+            (b["ttfb_ms"]["p50"], a["ttfb_ms"]["p50"]),
+            (b["throughput_rps"], a["throughput_rps"]),
+        ]
+        cells = "  ".join(f"{new:10.2f} {change(old, new)}" for old, new in columns)
+        print(f"{key[0]:12} {key[1]:6} {key[2]:>3}  {cells}")
+
+
+if __name__ == "__main__":
+    main()
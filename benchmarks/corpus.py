@@ -0,0 +1,106 @@
+"""Synthetic sticker corpus for the benchmarks.
+
+Everything is generated on the fly so the repository does not have to ship
+binary fixtures: Lottie animations of increasing complexity packed as TGS,
+short VP9 WebM clips (requires ``ffmpeg`` on PATH) and PNG/WebP images.
+"""
+import gzip
+import io
+import json
+import subprocess
+from typing import Dict, NamedTuple
+
+from PIL import Image, ImageDraw
+
+
+class CorpusItem(NamedTuple):
+    name: str
+    kind: str  # "tgs", "webm" or "static"
+    data: bytes
+
+    @property
+    def is_animated(self) -> bool:
+        return self.kind == "tgs"
+
+    @property
+    def is_video(self) -> bool:
+        return self.kind == "webm"
+
+
+def _static(value):
+    return {"a": 0, "k": value}
+
+
+def _animated(start, end, frames):
+    # rlottie needs easing handles on a keyframe, otherwise the property renders as nothing.
+    ease = {"x": [0.5], "y": [0.5]}
+    return {"a": 1, "k": [{"t": 0, "s": start, "i": ease, "o": ease}, {"t": frames, "s": end}]}
+
+
+def synthetic_tgs(frames: int = 180, fps: int = 60, layers: int = 1, shapes_per_layer: int = 1) -> bytes:
+    """Rotating, colour-shifting rounded squares; render cost grows with ``layers * shapes_per_layer``."""
+    lottie_layers = []
+    for layer in range(layers):
+        shapes = []
+        for shape in range(shapes_per_layer):
+            offset = (shape - shapes_per_layer / 2) * 24
+            shapes.append({
+                "ty": "gr",
+                "it": [
+                    {"ty": "rc", "p": _static([offset, offset]), "s": _static([240 - shape * 8, 240 - shape * 8]),
+                     "r": _static(24)},
+                    {"ty": "fl", "o": _static(60), "c": _animated([1, shape / max(1, shapes_per_layer), 0, 1],
+                                                                  [0, 0, 1, 1], frames)},
+                    {"ty": "st", "o": _static(100), "w": _static(4), "c": _static([0, 0, 0, 1])},
+                    {"ty": "tr", "p": _static([0, 0]), "a": _static([0, 0]), "s": _static([100, 100]),
+                     "r": _static(0), "o": _static(100)},
+                ],
+            })
+        lottie_layers.append({
+            "ty": 4, "ip": 0, "op": frames, "st": 0,
+            "ks": {
+                "o": _static(100),
+                "r": _animated([layer * 15], [360 + layer * 15], frames),
+                "p": _static([256, 256, 0]),
+                "a": _static([0, 0, 0]),
+                "s": _animated([100, 100, 100], [40 + layer * 10, 40 + layer * 10, 100], frames),
+            },
+            "shapes": shapes,
+        })
+    lottie = {"v": "5.5.2", "fr": fps, "ip": 0, "op": frames, "w": 512, "h": 512, "layers": lottie_layers}
+    return gzip.compress(json.dumps(lottie).encode("utf-8"))
+
+
+def synthetic_webm(duration: float = 3.0, fps: int = 30, size: int = 512) -> bytes:
+    result = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi",
+         "-i", f"testsrc2=size={size}x{size}:rate={fps}:duration={duration}",
+         "-c:v", "libvpx-vp9", "-b:v", "256k", "-f", "webm", "pipe:1"],
+        capture_output=True, check=True,
+    )
+    return result.stdout
+
+
+def synthetic_image(out_format: str, size: int = 512) -> bytes:
+    image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, size, 32):
+        draw.ellipse((i // 2, i // 2, size - i // 2, size - i // 2),
+                     fill=(i % 256, 255 - i % 256, (i * 3) % 256, 255))
+    output = io.BytesIO()
+    image.save(output, format=out_format.upper())
+    return output.getvalue()
+
+
+def build_corpus(include_video: bool = True) -> Dict[str, CorpusItem]:
+    items = [
+        CorpusItem("tgs-simple", "tgs", synthetic_tgs(layers=1, shapes_per_layer=1)),
+        CorpusItem("tgs-medium", "tgs", synthetic_tgs(layers=4, shapes_per_layer=4)),
+        CorpusItem("tgs-complex", "tgs", synthetic_tgs(layers=12, shapes_per_layer=8)),
+        CorpusItem("png", "static", synthetic_image("png")),
+        CorpusItem("webp", "static", synthetic_image("webp")),
+    ]
+    if include_video:
+        items.append(CorpusItem("webm-1s", "webm", synthetic_webm(duration=1.0)))
+        items.append(CorpusItem("webm-3s", "webm", synthetic_webm(duration=3.0)))
+    return {item.name: item for item in items}
@@ -0,0 +1,69 @@
+"""Local stand-in for the parts of ``telegram.Bot`` the service uses.
+
+File ids have the form ``<corpus item>#<suffix>``. Every distinct id gets its
+own ``file_unique_id``, so benchmarks can choose between repeated ids (cache
+and single-flight hits) and fresh ids (cold conversions).
+"""
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple
+
+from corpus import CorpusItem
+
+
+class FakeFile:
+    def __init__(self, bot: "FakeBot", file_id: str, item: CorpusItem):
+        self.file_id = file_id
+        self.file_unique_id = f"u-{file_id}"
+        self.file_path = f"stickers/{file_id}"
+        self.file_size = len(item.data)
+        self.__bot = bot
+        self.__item = item
+
+    async def download_as_bytearray(self, buf=None) -> bytearray:
+        started = time.perf_counter()
+        await asyncio.sleep(self.__bot.download_latency)
+        data = bytearray(self.__item.data)
+        self.__bot.timings["download"].append(time.perf_counter() - started)
+        return data
+
+
+class FakeSticker(NamedTuple):
+    file_id: str
+    file_unique_id: str
+    is_animated: bool
+    is_video: bool
+    width: int
+    height: int
+
+
+class FakeStickerSet(NamedTuple):
+    name: str
+    stickers: List[FakeSticker]
+
+
+class FakeBot:
+    def __init__(self, corpus: Dict[str, CorpusItem], api_latency: float = 0.0, download_latency: float = 0.0):
+        self.corpus = corpus
+        self.api_latency = api_latency
+        self.download_latency = download_latency
+        self.timings = defaultdict(list)
+
+    def item_for(self, file_id: str) -> CorpusItem:
+        return self.corpus[file_id.split("#", 1)[0]]
+
+    async def get_file(self, file_id: str, **kwargs) -> FakeFile:
+        started = time.perf_counter()
+        await asyncio.sleep(self.api_latency)
+        file_info = FakeFile(self, file_id, self.item_for(file_id))
+        self.timings["get_file"].append(time.perf_counter() - started)
+        return file_info
+
+    async def get_sticker_set(self, name: str, **kwargs) -> FakeStickerSet:
+        await asyncio.sleep(self.api_latency)
+        stickers = [
+            FakeSticker(f"{item.name}#{name}", f"u-{item.name}#{name}", item.is_animated, item.is_video, 512, 512)
+            for item in self.corpus.values()
+        ]
+        return FakeStickerSet(name, stickers)
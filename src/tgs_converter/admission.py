@@ -0,0 +1,209 @@
+"""Admission control for conversions.
+
+Each processor class (animated, video, static) gets its own
+:class:`ConcurrencyLimiter`: a fixed number of conversions run at once, a
+bounded number wait in FIFO order, and anything beyond that — or anything whose
+deadline cannot be met given the current queue — is turned away immediately
+instead of piling up behind work that will time out anyway. A
+:class:`PresetLadder` reads the same limiter to trade output size for encoding
+speed as the load grows.
+"""
+import asyncio
+import contextlib
+import math
+import os
+import time
+from collections import deque
+from os import environ
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from tgs_converter.metrics import ADMISSION_ACTIVE, ADMISSION_REJECTED, ADMISSION_WAITING, ENCODE_TIER, \
+    ENCODE_TIER_LEVEL
+from tgs_converter.options import ENCODE_TIERS
+
+
+class AdmissionRejected(Exception):
+    """The conversion was not started because the service is saturated."""
+    pass
+
+
+class ConcurrencyLimiter:
+    """Bounds the number of concurrent conversions of one processor class.
+
+    ``limit`` of zero or less disables the limiter. A request that finds a
+    free slot is always admitted. One that would have to queue is rejected
+    right away if its deadline falls before its estimated completion: the wait
+    is estimated from a moving average of how long conversions held their slot,
+    and the conversion itself from the same average kept per output format.
+    """
+
+    SMOOTHING = 0.2
+    RECENT_SAMPLES = 200
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.service_time = 0.0
+        self.__service_times: Dict[str, float] = {}
+        self.__waiters: Deque[asyncio.Future] = deque()
+        self.__recent: Deque[float] = deque(maxlen=self.RECENT_SAMPLES)
+
+    @property
+    def waiting(self) -> int:
+        return len(self.__waiters)
+
+    def estimated_wait(self) -> float:
+        """Seconds a request arriving now is expected to wait for a slot."""
+        if self.limit <= 0 or self.active < self.limit:
+            return 0.0
+        return self.service_time * math.ceil((len(self.__waiters) + 1) / self.limit)
+
+    def format_service_time(self, out_format: str) -> float:
+        """Moving average of how long conversions to ``out_format`` held their slot; zero until one has."""
+        return self.__service_times.get(out_format, 0.0)
+
+    def recent_service_time(self, q: float) -> float:
+        """The ``q`` quantile of how long the last few hundred conversions held their slot."""
+        if not self.__recent:
+            return 0.0
+        ordered = sorted(self.__recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, deadline: Optional[float] = None, out_format: str = '') -> AsyncIterator[None]:
+        """Hold one of the limiter's slots for a conversion to ``out_format``.
+
+        ``deadline`` is a ``time.monotonic()`` value.
+        """
+        if self.limit <= 0:
+            yield
+            return
+
+        await self.__acquire(deadline, out_format)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self.service_time = self.__smooth(self.service_time, elapsed)
+            self.__service_times[out_format] = self.__smooth(self.__service_times.get(out_format, 0.0), elapsed)
+            self.__recent.append(elapsed)
+            self.__release()
+
+    def __smooth(self, average: float, sample: float) -> float:
+        return average + self.SMOOTHING * (sample - average) if average else sample
+
+    async def __acquire(self, deadline: Optional[float], out_format: str):
+        if self.active < self.limit and not self.__waiters:
+            self.__take()
+            return
+
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= self.estimated_wait() + self.format_service_time(out_format):
+                self.__reject('deadline', 'the deadline would be exceeded before the conversion could finish')
+
+        if len(self.__waiters) >= self.max_queue:
+            self.__reject('queue_full', 'too many conversions are waiting')
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.__waiters.append(waiter)
+        ADMISSION_WAITING.inc(processor=self.name)
+        try:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            self.__abandon(waiter)
+            self.__reject('deadline', 'the deadline passed while waiting for a free slot')
+        except BaseException:
+            self.__abandon(waiter)
+            raise
+        finally:
+            ADMISSION_WAITING.dec(processor=self.name)
+
+    def __take(self):
+        self.active += 1
+        ADMISSION_ACTIVE.inc(processor=self.name)
+
+    def __release(self):
+        self.active -= 1
+        ADMISSION_ACTIVE.dec(processor=self.name)
+        while self.__waiters and self.active < self.limit:
+            waiter = self.__waiters.popleft()
+            if not waiter.done():
+                # The slot is handed over directly so no newcomer can jump the queue.
+                self.__take()
+                waiter.set_result(None)
+
+    def __abandon(self, waiter: asyncio.Future):
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just as the wait ended; pass it on.
+            self.__release()
+            return
+        waiter.cancel()
+        with contextlib.suppress(ValueError):
+            self.__waiters.remove(waiter)
+
+    def __reject(self, reason: str, message: str):
+        ADMISSION_REJECTED.inc(processor=self.name, reason=reason)
+        raise AdmissionRejected(f'{self.name} conversions are overloaded: {message}')
+
+
+def build_limiter(name: str) -> ConcurrencyLimiter:
+    """Read ``MAX_CONCURRENT_<NAME>`` and ``MAX_QUEUED_<NAME>`` from the environment."""
+    cpu_count = os.cpu_count() or 1
+    default_limit = cpu_count * 4 if name == 'static' else cpu_count * 2
+    limit = int(environ.get(f"MAX_CONCURRENT_{name.upper()}", str(default_limit)))
+    return ConcurrencyLimiter(
+        name,
+        limit=limit,
+        max_queue=int(environ.get(f"MAX_QUEUED_{name.upper()}", str(max(limit, 1) * 4))),
+    )
+
+
+class PresetLadder:
+    """Picks the encoder settings tier for a processor's conversions from its load.
+
+    A conversion started while its processor has room gets the best
+    compression. Once every slot is taken, or the latency a new request can
+    expect (its estimated wait plus the recent p99 service time) passes
+    ``BALANCED_AT`` of the SLO, it gets the balanced tier; once requests queue,
+    or that latency passes ``FAST_AT`` of the SLO, the fastest. ``pinned``
+    fixes the tier regardless of load.
+    """
+
+    BALANCED_AT = 0.5
+    FAST_AT = 0.8
+
+    def __init__(self, limiter: ConcurrencyLimiter, slo: float, pinned: str = ''):
+        self.limiter = limiter
+        self.slo = slo
+        self.pinned = pinned
+
+    def projected_latency(self) -> float:
+        return self.limiter.estimated_wait() + self.limiter.recent_service_time(0.99)
+
+    def choose(self, out_format: str) -> str:
+        tier = self.pinned or self.__tier()
+        ENCODE_TIER.inc(processor=self.limiter.name, format=out_format, tier=tier)
+        ENCODE_TIER_LEVEL.set(ENCODE_TIERS.index(tier), processor=self.limiter.name)
+        return tier
+
+    def __tier(self) -> str:
+        limiter = self.limiter
+        projected = self.projected_latency() if self.slo > 0 else 0.0
+        if limiter.waiting or projected > self.FAST_AT * self.slo:
+            return 'fast'
+        if 0 < limiter.limit <= limiter.active or projected > self.BALANCED_AT * self.slo:
+            return 'balanced'
+        return 'quality'
+
+
+def build_ladder(limiter: ConcurrencyLimiter) -> PresetLadder:
+    """Read ``LATENCY_SLO_MS`` and ``ENCODE_TIER`` from the environment."""
+    pinned = environ.get("ENCODE_TIER", "")
+    if pinned and pinned not in ENCODE_TIERS:
+        raise ValueError(f"ENCODE_TIER must be one of {', '.join(ENCODE_TIERS)}, got {pinned!r}")
+    return PresetLadder(limiter, slo=float(environ.get("LATENCY_SLO_MS", "5000")) / 1000, pinned=pinned)
@@ -1,12 +1,114 @@
-import os
-import sys
+import time
+from collections import OrderedDict
+from os import environ
+from typing import TYPE_CHECKING, Optional, Tuple, Union
 
-from telegram import Bot
+from tgs_converter.cache import MemoryLRUCache
 
-token = os.environ.get("TELEGRAM_TOKEN")
-if token is None:
-    print("Please set TELEGRAM_TOKEN environment variable")
-    sys.exit(1)
+if TYPE_CHECKING:
+    from telegram import Bot, File
 
-bot = Bot(token=token)
 
+class TelegramDownloader:
+    """Resolves and downloads sticker files, caching what Telegram lets us reuse.
+
+    ``file_id -> File`` lookups are cached for ``file_info_ttl`` seconds, which
+    must stay below the one hour Telegram guarantees a download link to be
+    valid for. Downloaded files are kept in a byte-bounded LRU keyed by the
+    file's unique id, and are handed to the processors as the downloaded
+    ``bytearray`` without a defensive copy; callers must not mutate them.
+    """
+
+    # A download from a link resolved less than this long ago is not retried:
+    # a failure so soon is not down to the link having expired.
+    FRESH_LINK_AGE = 60.0
+
+    def __init__(self, bot: "Bot", file_info_ttl: float, file_info_entries: int, raw_cache_bytes: int):
+        self.bot = bot
+        self.file_info_ttl = file_info_ttl
+        self.file_info_entries = file_info_entries
+        self.files = MemoryLRUCache(raw_cache_bytes)
+        # file_id -> (when the link was resolved, File)
+        self.__file_infos: "OrderedDict[str, Tuple[float, File]]" = OrderedDict()
+
+    async def get_file_info(self, file_id: str) -> "File":
+        cached = self.__file_infos.get(file_id)
+        if cached is not None:
+            resolved_at, file_info = cached
+            if resolved_at + self.file_info_ttl > time.monotonic():
+                self.__file_infos.move_to_end(file_id)
+                return file_info
+            del self.__file_infos[file_id]
+
+        file_info = await self.bot.get_file(file_id=file_id)
+        if file_info.file_path:
+            self.__file_infos[file_id] = (time.monotonic(), file_info)
+            while len(self.__file_infos) > self.file_info_entries:
+                self.__file_infos.popitem(last=False)
+        return file_info
+
+    def cached_file(self, file_info: "File") -> Optional[Union[bytes, bytearray]]:
+        if not file_info.file_unique_id:
+            return None
+        return self.files.get(file_info.file_unique_id)
+
+    async def download(self, file_info: "File") -> Union[bytes, bytearray]:
+        cached = self.cached_file(file_info)
+        if cached is not None:
+            return cached
+
+        try:
+            data = await file_info.download_as_bytearray()
+        except Exception:
+            if not self.__may_be_stale(file_info):
+                raise
+            # A cached path may have outlived its link; resolve it again once.
+            del self.__file_infos[file_info.file_id]
+            file_info = await self.get_file_info(file_info.file_id)
+            data = await file_info.download_as_bytearray()
+
+        if file_info.file_unique_id:
+            self.files.put(file_info.file_unique_id, data)
+        return data
+
+    def __may_be_stale(self, file_info: "File") -> bool:
+        """Whether ``file_info`` is a cached lookup whose link was resolved a while ago."""
+        cached = self.__file_infos.get(file_info.file_id)
+        if cached is None or cached[1] is not file_info:
+            return False
+        return time.monotonic() - cached[0] >= self.FRESH_LINK_AGE
+
+
+_downloader: Optional[TelegramDownloader] = None
+
+
+def build_bot() -> "Bot":
+    """Create the Bot API client; python-telegram-bot is only imported here, as it is slow to load."""
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    token = environ.get("TELEGRAM_TOKEN")
+    if not token:
+        raise RuntimeError("Please set TELEGRAM_TOKEN environment variable")
+    # One pool serves both Bot API calls and file downloads; keep enough
+    # keep-alive connections around for a full sticker-set fan-out.
+    request = HTTPXRequest(
+        connection_pool_size=int(environ.get("TELEGRAM_POOL_SIZE", "128")),
+        connect_timeout=float(environ.get("TELEGRAM_CONNECT_TIMEOUT", "5")),
+        read_timeout=float(environ.get("TELEGRAM_READ_TIMEOUT", "10")),
+        pool_timeout=float(environ.get("TELEGRAM_POOL_TIMEOUT", "5")),
+    )
+    return Bot(token=token, request=request)
+
+
+def get_downloader() -> TelegramDownloader:
+    """The process-wide downloader, created on first use."""
+    global _downloader
+    if _downloader is None:
+        _downloader = TelegramDownloader(
+            build_bot(),
+            file_info_ttl=float(environ.get("FILE_INFO_TTL", "3000")),
+            file_info_entries=int(environ.get("FILE_INFO_CACHE_ENTRIES", "100000")),
+            raw_cache_bytes=int(environ.get("RAW_FILE_CACHE_BYTES", str(128 * 2 ** 20))),
+        )
+    return _downloader
@@ -0,0 +1,93 @@
+"""Reusable raw frame buffers under a process-wide memory budget.
+
+A 1024x1024 BGRA frame is 4 MiB; allocating a fresh one per rendered frame
+makes RSS swing with load and costs a page fault per page. Conversions instead
+lease a few buffers for their whole run, render into them in rotation, and
+hand them back for the next conversion of the same size.
+"""
+import contextlib
+import threading
+from collections import defaultdict
+from os import environ
+from typing import Callable, Dict, Iterator, List, Optional
+
+from tgs_converter.errors import ConversionCancelled, ConvertationError
+from tgs_converter.metrics import FRAME_BUFFER_BYTES
+
+
+class FrameBufferPool:
+    """Leases ``bytearray`` frame buffers.
+
+    At most ``max_bytes`` are leased out at once; a lease that does not fit
+    waits until enough is returned. Returned buffers are kept for reuse up to
+    ``max_idle_bytes``, so the pool's footprint is bounded by the sum of both.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, max_bytes: int, max_idle_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_idle_bytes = max_idle_bytes
+        self.leased = 0
+        self.idle = 0
+        self.__free: Dict[int, List[bytearray]] = defaultdict(list)
+        self.__condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def lease(self, size: int, count: int, cancelled: Optional[Callable[[], bool]] = None) -> Iterator[List[bytearray]]:
+        """Lease ``count`` buffers of ``size`` bytes, waiting for budget if needed."""
+        total = size * count
+        if total > self.max_bytes:
+            raise ConvertationError(f'Frames of {size} bytes do not fit the frame memory budget')
+        with self.__condition:
+            while self.leased + total > self.max_bytes:
+                if cancelled is not None and cancelled():
+                    raise ConversionCancelled('Stopped waiting for frame memory, the conversion was cancelled')
+                self.__condition.wait(self.POLL_INTERVAL)
+            self.leased += total
+            free = self.__free[size]
+            buffers = [free.pop() for _ in range(min(count, len(free)))]
+            self.idle -= size * len(buffers)
+            FRAME_BUFFER_BYTES.set(self.leased, state="leased")
+            FRAME_BUFFER_BYTES.set(self.idle, state="idle")
+        buffers.extend(bytearray(size) for _ in range(count - len(buffers)))
+        try:
+            yield buffers
+        finally:
+            self.__return(size, buffers)
+
+    def __return(self, size: int, buffers: List[bytearray]):
+        with self.__condition:
+            self.leased -= size * len(buffers)
+            free = self.__free[size]
+            for buffer in buffers:
+                if self.idle + size > self.max_idle_bytes:
+                    self.__trim(size)
+                if self.idle + size > self.max_idle_bytes:
+                    break
+                free.append(buffer)
+                self.idle += size
+            self.__condition.notify_all()
+            FRAME_BUFFER_BYTES.set(self.leased, state="leased")
+            FRAME_BUFFER_BYTES.set(self.idle, state="idle")
+
+    def __trim(self, keep_size: int):
+        # Make room by dropping idle buffers of other sizes first.
+        for size, free in list(self.__free.items()):
+            if size == keep_size:
+                continue
+            while free and self.idle + keep_size > self.max_idle_bytes:
+                free.pop()
+                self.idle -= size
+            if not free:
+                del self.__free[size]
+
+
+frame_buffers = FrameBufferPool(
+    max_bytes=int(environ.get("FRAME_MEMORY_BUDGET_BYTES", str(512 * 2 ** 20))),
+    max_idle_bytes=int(environ.get("FRAME_MEMORY_IDLE_BYTES", str(64 * 2 ** 20))),
+)
+
+# Upper bound on the frame buffers a single conversion may lease; it caps how
+# many frames are rendered ahead of the encoder.
+REQUEST_FRAME_MEMORY_BYTES = int(environ.get("REQUEST_FRAME_MEMORY_BYTES", str(64 * 2 ** 20)))
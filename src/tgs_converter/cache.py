@@ -0,0 +1,287 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from os import environ
+from typing import Optional
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_cache_key(content_id: str, out_format: str, width: int, height: int, variant: str = "") -> str:
+    key = f"{content_id}:{out_format}:{width}x{height}"
+    if variant:
+        key = f"{key}:{variant}"
+    return key
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def snapshot(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class MemoryLRUCache:
+    """In-memory LRU bounded by the total size of the stored values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = CacheStats()
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.__lock:
+            value = self.__entries.get(key)
+            if value is None:
+                self.stats.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.__entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.__entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats.evictions += 1
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__entries
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+
+class DiskCache:
+    """Size-bounded on-disk store, evicting the least recently used files first.
+
+    Entries are written to a temporary file and renamed into place, so an
+    interrupted write never leaves a truncated entry behind. Several processes
+    may share a directory: entries another process wrote are picked up on
+    first read, though each process only accounts for the entries it knows.
+    Temporary files left by writers that died are removed on start-up; those
+    of live writers are left alone.
+    """
+
+    # A writer whose pid is gone may still be alive in another PID namespace
+    # sharing the directory, so its file is only removed after a grace period.
+    DEAD_WRITER_GRACE = 60.0
+    STALE_TMP_AGE = 3600.0
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = CacheStats()
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.__load_index()
+
+    def __load_index(self):
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(".tmp"):
+                if self.__is_stale(name, time.time() - st.st_mtime):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            found.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self.__entries[name] = size
+            self.size += size
+        self.__evict()
+
+    def __is_stale(self, tmp_name: str, age: float) -> bool:
+        if age >= self.STALE_TMP_AGE:
+            return True
+        if age < self.DEAD_WRITER_GRACE:
+            return False
+        # Named <entry>.<pid>.<thread>.tmp by put().
+        try:
+            pid = int(tmp_name.split(".")[1])
+        except (IndexError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def __path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def __name(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        name = self.__name(key)
+        with self.__lock:
+            known = name in self.__entries
+            if known:
+                self.__entries.move_to_end(name)
+        try:
+            with open(self.__path(name), "rb") as f:
+                value = f.read()
+            os.utime(self.__path(name))
+        except FileNotFoundError:
+            with self.__lock:
+                size = self.__entries.pop(name, None)
+                if size is not None:
+                    self.size -= size
+                self.stats.misses += 1
+            return None
+        if not known:
+            # Written by a sibling worker or by tgs-converter-warm.
+            with self.__lock:
+                if name not in self.__entries:
+                    self.__entries[name] = len(value)
+                    self.size += len(value)
+                    self.__evict()
+        self.stats.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        name = self.__name(key)
+        tmp_path = self.__path(f"{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, self.__path(name))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        with self.__lock:
+            old = self.__entries.pop(name, None)
+            if old is not None:
+                self.size -= old
+            self.__entries[name] = len(value)
+            self.size += len(value)
+            self.__evict()
+
+    def __evict(self):
+        while self.size > self.max_bytes and self.__entries:
+            name, size = self.__entries.popitem(last=False)
+            self.size -= size
+            self.stats.evictions += 1
+            try:
+                os.unlink(self.__path(name))
+            except FileNotFoundError:
+                pass
+
+    def __contains__(self, key: str) -> bool:
+        return self.__name(key) in self.__entries
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+
+class ResultCache:
+    """Two-tier store of finished conversions: a hot memory LRU in front of an optional disk tier.
+
+    Disk hits are promoted into the memory tier. The async helpers run disk I/O
+    in the default executor so the event loop is never blocked on the filesystem.
+    """
+
+    def __init__(self, memory: MemoryLRUCache, disk: Optional[DiskCache] = None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self.memory.get(key)
+        if value is not None or self.disk is None:
+            return value
+        value = self.disk.get(key)
+        if value is not None:
+            self.memory.put(key, value)
+        return value
+
+    def put(self, key: str, value: bytes):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        value = self.memory.get(key)
+        if value is not None or self.disk is None:
+            return value
+        value = await asyncio.get_running_loop().run_in_executor(None, self.disk.get, key)
+        if value is not None:
+            self.memory.put(key, value)
+        return value
+
+    async def aput(self, key: str, value: bytes):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.disk.put, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.memory or (self.disk is not None and key in self.disk)
+
+    @property
+    def max_entry_bytes(self) -> int:
+        """Size of the largest value any tier would keep."""
+        return max(self.memory.max_bytes, self.disk.max_bytes if self.disk is not None else 0)
+
+    def stats(self) -> dict:
+        stats = {"memory": self.memory.stats.snapshot()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats.snapshot()
+        return stats
+
+
+def build_result_cache() -> ResultCache:
+    memory = MemoryLRUCache(int(environ.get("RESULT_CACHE_MEMORY_BYTES", str(64 * 2 ** 20))))
+    disk = None
+    cache_dir = environ.get("RESULT_CACHE_DIR")
+    if cache_dir:
+        disk = DiskCache(cache_dir, int(environ.get("RESULT_CACHE_DISK_BYTES", str(2 ** 30))))
+    return ResultCache(memory, disk)
+
+
+_result_cache: Optional[ResultCache] = None
+
+
+def get_result_cache() -> ResultCache:
+    """The process-wide result cache, built on first use.
+
+    Engine pool workers import this module too; building the cache lazily keeps
+    them from scanning the disk tier's directory.
+    """
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = build_result_cache()
+    return _result_cache
@@ -0,0 +1,704 @@
+"""Blocking conversion routines executed by the engine's worker pools.
+
+Everything here is synchronous and importable without grpc or the bot, so the
+functions can be shipped to spawned worker processes.
+"""
+import contextlib
+import ctypes
+import gzip
+import io
+import itertools
+import os
+import queue
+import subprocess
+import threading
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from os import environ
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import ffmpeg
+from PIL import Image
+from rlottie_python import LottieAnimation
+
+from tgs_converter.buffers import REQUEST_FRAME_MEMORY_BYTES, frame_buffers
+from tgs_converter.cache import CacheStats, content_hash
+from tgs_converter.encoders import ENCODE_PRESETS, ChunkSink, get_encoder, stream_ffmpeg, tier_args
+from tgs_converter.engine import CancelToken, current_cancel_token
+from tgs_converter.errors import ConversionCancelled, ConvertationError
+from tgs_converter.metrics import STAGE_DURATION, StageClock, profile_frame_loop, stage
+from tgs_converter.options import ANIMATED_FORMATS, DEFAULT_OPTIONS, SEQUENCE_FORMATS, STATIC_FORMATS, \
+    ConversionOptions
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+IMAGE_SAVE_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP'}
+# Passed to Image.resize; with a gap of 2 the result is nearly indistinguishable
+# from a plain resize while large downscales get several times cheaper.
+RESIZE_REDUCING_GAP = 2.0
+
+
+def select_frames(total_frames: int, native_fps: float, options: ConversionOptions) -> Tuple[List[int], float]:
+    """Pick the source frames to render and the frame rate to encode them at.
+
+    Frames are sampled evenly when the target rate is below the native one, and
+    the sequence is cut at ``max_duration_ms`` and ``max_frames``.
+    """
+    fps = native_fps
+    if 0 < options.target_fps < native_fps:
+        fps = options.target_fps
+    step = native_fps / fps
+
+    duration = total_frames / native_fps
+    if options.max_duration_ms:
+        duration = min(duration, options.max_duration_ms / 1000)
+    count = max(1, int(duration * fps + 1e-9))
+    if options.max_frames:
+        count = min(count, options.max_frames)
+
+    frames = [min(total_frames - 1, int(i * step)) for i in range(count)]
+    return frames, fps
+
+
+def load_animation(data: bytes) -> LottieAnimation:
+    return _load_animation(data)[0]
+
+
+def _load_animation(data: bytes) -> Tuple[LottieAnimation, int]:
+    try:
+        lottie_json = gzip.decompress(data).decode('utf-8')
+    except (OSError, EOFError, zlib.error, UnicodeDecodeError) as e:
+        raise ConvertationError(f'Invalid TGS data: {e}')
+    animation = LottieAnimation.from_data(lottie_json)
+    # rlottie reports malformed JSON with a null handle rather than an error.
+    if not animation.animation_p:
+        raise ConvertationError('Invalid TGS data: rlottie could not parse the animation')
+    return animation, len(lottie_json)
+
+
+class AnimationCache:
+    """Pool of parsed animations keyed by the TGS content hash.
+
+    rlottie animations must not be rendered from two threads at once, so an
+    animation is checked out exclusively for the duration of a conversion and
+    returned to the pool afterwards; concurrent conversions of the same sticker
+    each get their own instance. Idle instances are evicted least recently used
+    first once either the entry count or the estimated memory is exceeded. The
+    memory estimate is the size of the decompressed Lottie JSON.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = CacheStats()
+        self.__idle: "OrderedDict[str, List[Tuple[LottieAnimation, int]]]" = OrderedDict()
+        self.__count = 0
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def acquire(self, data: bytes) -> Iterator[LottieAnimation]:
+        key = content_hash(data)
+        entry = None
+        with self.__lock:
+            idle = self.__idle.get(key)
+            if idle:
+                entry = idle.pop()
+                if not idle:
+                    del self.__idle[key]
+                self.__count -= 1
+                self.size -= entry[1]
+                self.stats.hits += 1
+            else:
+                self.stats.misses += 1
+        if entry is None:
+            entry = _load_animation(data)
+        try:
+            yield entry[0]
+        finally:
+            self.__release(key, entry)
+
+    def __release(self, key: str, entry: Tuple[LottieAnimation, int]):
+        if self.max_entries <= 0 or entry[1] > self.max_bytes:
+            return
+        with self.__lock:
+            self.__idle.setdefault(key, []).append(entry)
+            self.__idle.move_to_end(key)
+            self.__count += 1
+            self.size += entry[1]
+            while self.__count > self.max_entries or self.size > self.max_bytes:
+                oldest_key, idle = next(iter(self.__idle.items()))
+                _, cost = idle.pop(0)
+                if not idle:
+                    del self.__idle[oldest_key]
+                self.__count -= 1
+                self.size -= cost
+                self.stats.evictions += 1
+
+    def __len__(self) -> int:
+        return self.__count
+
+
+animation_cache = AnimationCache(
+    max_entries=int(environ.get("ANIMATION_CACHE_ENTRIES", "64")),
+    max_bytes=int(environ.get("ANIMATION_CACHE_BYTES", str(64 * 2 ** 20))),
+)
+
+
+_render_prototype = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p,
+                                     ctypes.c_size_t, ctypes.c_size_t, ctypes.c_size_t)
+_render_functions = {}
+
+
+def _render_function(animation: LottieAnimation):
+    lib = animation.rlottie_lib
+    render = _render_functions.get(lib._handle)
+    if render is None:
+        render = _render_functions.setdefault(lib._handle, _render_prototype(("lottie_animation_render", lib)))
+    return render
+
+
+def render_frame(animation: LottieAnimation, frame_num: int, width: int, height: int) -> bytes:
+    """Thread-safe replacement for ``LottieAnimation.lottie_animation_render``.
+
+    The library method rewrites the shared ``argtypes`` of the C function on
+    every call, which breaks when threads render different sizes at once. This
+    binds a private function object per loaded library instead.
+    """
+    buffer = ctypes.create_string_buffer(width * height * 4)
+    _render_function(animation)(animation.animation_p, frame_num, buffer, width, height, width * 4)
+    return buffer.raw
+
+
+def render_frame_into(animation: LottieAnimation, frame_num: int, width: int, height: int,
+                      buffer: bytearray) -> bytearray:
+    """Like :func:`render_frame`, but renders into ``buffer`` in place and returns it."""
+    target = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+    _render_function(animation)(animation.animation_p, frame_num, target, width, height, width * 4)
+    return buffer
+
+
+# Frames of one conversion are rendered by up to RENDER_THREADS animation
+# instances at once; all conversions share a pool of RENDER_POOL_SIZE threads.
+RENDER_THREADS = int(environ.get("RENDER_THREADS", str(min(4, os.cpu_count() or 1))))
+RENDER_POOL_SIZE = int(environ.get("RENDER_POOL_SIZE", str(os.cpu_count() or 1)))
+# Below this many frames per thread the extra instances are not worth parsing.
+MIN_FRAMES_PER_RENDER_THREAD = 16
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def _get_render_pool() -> ThreadPoolExecutor:
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ThreadPoolExecutor(RENDER_POOL_SIZE, thread_name_prefix="tgs-render")
+        return _render_pool
+
+
+def iter_animated(data: bytes, out_format: str, width: int, height: int,
+                  options: ConversionOptions = DEFAULT_OPTIONS) -> Iterator[bytes]:
+    started = time.perf_counter()
+    with animation_cache.acquire(data) as animation:
+        # Cache hits record a near-zero parse, which is what they cost.
+        STAGE_DURATION.observe(time.perf_counter() - started, stage="parse", processor="animated", format=out_format)
+        yield from _iter_animation(animation, data, out_format, width, height, options)
+
+
+def _render_frames(animation: LottieAnimation, data: bytes, frame_numbers: List[int], width: int, height: int,
+                   label: str, cancel: CancelToken) -> Iterator[bytearray]:
+    """Yield the rendered frames in order.
+
+    Frames are rendered into a few leased buffers that are reused in rotation:
+    a yielded frame is only valid until the next one is requested.
+    """
+    frame_size = width * height * 4
+    affordable = REQUEST_FRAME_MEMORY_BYTES // frame_size
+    if affordable < 1:
+        raise ConvertationError(f'A {width}x{height} frame exceeds the per-request frame memory budget')
+    threads = min(RENDER_THREADS, len(frame_numbers) // MIN_FRAMES_PER_RENDER_THREAD, affordable - 1)
+    with frame_buffers.lease(frame_size, threads + 1 if threads > 1 else 1, cancel.cancelled) as buffers:
+        with profile_frame_loop(label):
+            if threads > 1:
+                yield from _render_parallel(animation, data, frame_numbers, width, height, buffers, cancel)
+                return
+            for i in frame_numbers:
+                if cancel.cancelled():
+                    raise ConversionCancelled('Rendering stopped, the conversion was cancelled')
+                yield render_frame_into(animation, i, width, height, buffers[0])
+
+
+def _render_parallel(animation: LottieAnimation, data: bytes, frame_numbers: List[int], width: int, height: int,
+                     buffers: List[bytearray], cancel: CancelToken) -> Iterator[bytearray]:
+    """Render frames on the shared render pool, one animation instance per pending frame.
+
+    Frames are submitted in order, ``len(buffers) - 1`` at a time, and yielded
+    in order as they complete: the pending window doubles as the reorder
+    buffer. Frame ``n`` goes into ``buffers[n % len(buffers)]``, so the renders
+    in flight never touch the buffer the consumer is still reading. Each render
+    checks out one of this conversion's instances, as rlottie animations are
+    not safe to render concurrently; with one instance per window slot it never
+    waits.
+    """
+    threads = len(buffers) - 1
+    pool = _get_render_pool()
+    with contextlib.ExitStack() as stack:
+        instances = queue.SimpleQueue()
+        instances.put(animation)
+        for _ in range(threads - 1):
+            instances.put(stack.enter_context(animation_cache.acquire(data)))
+
+        def render(frame_num: int, buffer: bytearray) -> bytearray:
+            instance = instances.get()
+            try:
+                return render_frame_into(instance, frame_num, width, height, buffer)
+            finally:
+                instances.put(instance)
+
+        jobs = ((i, buffers[n % len(buffers)]) for n, i in enumerate(frame_numbers))
+        pending = deque(pool.submit(render, *job) for job in itertools.islice(jobs, threads))
+        try:
+            while pending:
+                if cancel.cancelled():
+                    raise ConversionCancelled('Rendering stopped, the conversion was cancelled')
+                frame = pending.popleft().result()
+                for job in itertools.islice(jobs, 1):
+                    pending.append(pool.submit(render, *job))
+                yield frame
+        finally:
+            # Instances and buffers are released on exit, so no render may still be using them.
+            for future in pending:
+                future.cancel()
+            wait(pending)
+
+
+def _iter_animation(animation: LottieAnimation, data: bytes, out_format: str, width: int, height: int,
+                    options: ConversionOptions) -> Iterator[bytes]:
+    render = StageClock()
+    pipeline = StageClock()
+    # Looked up here: the ffmpeg backend pulls frames from its feeder thread.
+    cancel = current_cancel_token()
+    if out_format in ANIMATED_FORMATS:
+        frame_numbers, fps = select_frames(animation.lottie_animation_get_totalframe(),
+                                           animation.lottie_animation_get_framerate(), options)
+        encoder = get_encoder(out_format)
+        frames = render.wrap(_render_frames(animation, data, frame_numbers, width, height, f"animated-{out_format}", cancel))
+        yield from pipeline.wrap(encoder.encode(frames, out_format, width, height, fps, len(frame_numbers),
+                                                options.encode_tier))
+        render.observe("render", "animated", out_format)
+        # The ffmpeg backend pulls frames on its feeder thread, so rendering and
+        # encoding overlap; "encode" is the part of the wait not spent rendering.
+        pipeline.observe("encode", "animated", out_format, max(0.0, pipeline.seconds - render.seconds))
+        return
+
+    if out_format in SEQUENCE_FORMATS:
+        frame_numbers, _ = select_frames(animation.lottie_animation_get_totalframe(),
+                                         animation.lottie_animation_get_framerate(), options)
+        frames = render.wrap(_render_frames(animation, data, frame_numbers, width, height, f"animated-{out_format}", cancel))
+        pngs = (
+            encode_png(Image.frombuffer('RGBA', (width, height), frame, 'raw', 'BGRA', 0, 1), options)
+            for frame in frames
+        )
+        yield from pipeline.wrap(zip_frames(pngs))
+        render.observe("render", "animated", out_format)
+        pipeline.observe("encode", "animated", out_format, max(0.0, pipeline.seconds - render.seconds))
+        return
+
+    if out_format in STATIC_FORMATS:
+        with stage("render", "animated", out_format):
+            buffer = render_frame(animation, 0, width, height)
+        with stage("encode", "animated", out_format):
+            image = Image.frombuffer('RGBA', (width, height), buffer, 'raw', 'BGRA')
+            output = encode_image(image, out_format, options)
+
+        yield output
+        return
+
+    raise ConvertationError("Unsupported output format")
+
+
+def encode_png(image: Image.Image, options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
+    return encode_image(image, 'png', options)
+
+
+def encode_image(image: Image.Image, out_format: str, options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
+    """Encode an RGBA image as one of ``STATIC_FORMATS`` with the request's encoder settings."""
+    params = {}
+    if out_format == 'png':
+        if options.png_compress_level is not None:
+            params['compress_level'] = options.png_compress_level
+    elif out_format == 'webp':
+        if options.quality:
+            params['quality'] = options.quality
+        if options.webp_method is not None:
+            params['method'] = options.webp_method
+    elif out_format == 'jpg':
+        if options.quality:
+            params['quality'] = options.quality
+        # JPEG has no alpha channel, so transparent areas are flattened onto white.
+        flattened = Image.new('RGB', image.size, (255, 255, 255))
+        flattened.paste(image, mask=image.getchannel('A'))
+        image = flattened
+    else:
+        raise ConvertationError(f'Unsupported image format: {out_format}')
+    output = io.BytesIO()
+    image.save(output, format=IMAGE_SAVE_FORMATS[out_format], **params)
+    return output.getvalue()
+
+
+def zip_frames(pngs: Iterable[bytes]) -> Iterator[bytes]:
+    """Stream PNG frames as an uncompressed ZIP, one archive member per frame.
+
+    Each member is written and yielded as soon as its frame is available, so
+    only one frame is ever held in memory; the central directory follows the
+    last frame.
+    """
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for i, png in enumerate(pngs):
+            archive.writestr(zipfile.ZipInfo(f'frame_{i:04d}.png', date_time=(1980, 1, 1, 0, 0, 0)), png)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def split_png_stream(pieces: Iterable[bytes]) -> Iterator[bytes]:
+    """Split concatenated PNG files (ffmpeg's ``image2pipe`` output) into single images."""
+    buffer = bytearray()
+    position = 0
+    for piece in pieces:
+        buffer += piece
+        while True:
+            # position is the offset of the next chunk inside the current image.
+            if position == 0:
+                if len(buffer) < len(PNG_SIGNATURE):
+                    break
+                if not buffer.startswith(PNG_SIGNATURE):
+                    raise ConvertationError('Unexpected data in PNG stream')
+                position = len(PNG_SIGNATURE)
+            if len(buffer) < position + 8:
+                break
+            length = int.from_bytes(buffer[position:position + 4], 'big')
+            chunk_type = bytes(buffer[position + 4:position + 8])
+            end = position + 12 + length
+            if len(buffer) < end:
+                break
+            position = end
+            if chunk_type == b'IEND':
+                yield bytes(buffer[:end])
+                del buffer[:end]
+                position = 0
+    if buffer:
+        raise ConvertationError('Truncated PNG stream')
+
+
+def convert_animated(data: bytes, out_format: str, width: int, height: int,
+                     options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
+    return b''.join(iter_animated(data, out_format, width, height, options))
+
+
+def can_pass_through(data: bytes, in_format: str, out_format: str, width: int, height: int,
+                     options: ConversionOptions = DEFAULT_OPTIONS) -> bool:
+    """Whether a static image already is the requested output, so it can be returned as is.
+
+    Only the header is parsed, which is cheap enough to do outside the worker pools.
+    """
+    if in_format != out_format or options.has_encoder_settings():
+        return False
+    if not (width and height):
+        return True
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.size == (width, height)
+    except (OSError, ValueError):
+        # Left for convert_static to report.
+        return False
+
+
+def convert_static(data: bytes, out_format: str, width: int, height: int,
+                   options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    if width and height and image.size != (width, height):
+        # Large downscales shrink by an integer factor with a box reduction
+        # first, so the resampling filter only runs over the remainder. Opaque
+        # images are resized before the RGBA conversion, which then only
+        # touches the small result.
+        image = image.resize((width, height), reducing_gap=RESIZE_REDUCING_GAP)
+    image = image.convert('RGBA')
+
+    if out_format in SEQUENCE_FORMATS:
+        return b''.join(zip_frames([encode_png(image, options)]))
+
+    return encode_image(image, out_format, options)
+
+
+# Input codecs each output container can take as is, so that a request that
+# needs no rescaling or resampling is remuxed instead of re-encoded.
+REMUX_CODECS = {
+    'webm': {'vp8', 'vp9', 'av1'},
+    'mp4': {'h264', 'hevc', 'av1'},
+    'mov': {'h264', 'hevc'},
+}
+
+# Like ENCODE_PRESETS for the animated path: the fast tier, with the other
+# tiers taken from ENCODE_TIER_ARGS. Formats not listed use the muxer's
+# default codec.
+TRANSCODE_PRESETS = {
+    'mp4': ENCODE_PRESETS['mp4'],
+    'mov': {**ENCODE_PRESETS['mp4'], 'format': 'mov'},
+    'webm': {
+        'vcodec': 'libvpx-vp9',
+        'format': 'webm',
+        'pix_fmt': 'yuv420p',
+        'extra_args': {
+            'b:v': '0',
+            'crf': '32',
+            'deadline': 'realtime',
+            'cpu-used': '8',
+            'row-mt': '1',
+        },
+    },
+}
+
+# How much of a streamed upload is held back looking for the track header.
+VIDEO_HEADER_PEEK_BYTES = 2 ** 16
+
+MATROSKA_CODECS = {
+    'V_VP8': 'vp8',
+    'V_VP9': 'vp9',
+    'V_AV1': 'av1',
+    'V_MPEG4/ISO/AVC': 'h264',
+    'V_MPEGH/ISO/HEVC': 'hevc',
+}
+
+
+class VideoTrack(NamedTuple):
+    codec: str
+    width: int
+    height: int
+    # From the track's DefaultDuration; 0 when the muxer left it out.
+    fps: float = 0.0
+
+
+def _ebml_vint(data: bytes, position: int, keep_marker: bool) -> Tuple[int, int, int]:
+    """Decode an EBML variable-length integer; returns the value, its length and the next position."""
+    first = data[position]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or position + length > len(data):
+        raise ValueError('Invalid EBML integer')
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[position + 1:position + length]:
+        value = value << 8 | byte
+    return value, length, position + length
+
+
+def _ebml_elements(data: bytes, position: int, end: int) -> Iterator[Tuple[int, int, int]]:
+    """Yield ``(id, data offset, data size)`` for the EBML elements in ``data[position:end]``."""
+    while position < end:
+        element_id, _, position = _ebml_vint(data, position, keep_marker=True)
+        size, length, position = _ebml_vint(data, position, keep_marker=False)
+        if size == (1 << 7 * length) - 1:
+            # Unknown size, as written by live muxers: the element runs to the end.
+            size = end - position
+        yield element_id, position, size
+        position += size
+
+
+def webm_video_track(data: bytes) -> Optional[VideoTrack]:
+    """Codec and frame size of the first video track in a WebM/Matroska header, if readable.
+
+    Reading the header in-process is much cheaper than spawning a prober, and
+    only the front of the file is touched.
+    """
+    try:
+        for element_id, position, size in _ebml_elements(data, 0, len(data)):
+            if element_id != 0x18538067:  # Segment
+                continue
+            for child_id, child, child_size in _ebml_elements(data, position, min(len(data), position + size)):
+                if child_id == 0x1F43B675:  # Cluster: the header is over
+                    return None
+                if child_id != 0x1654AE6B:  # Tracks
+                    continue
+                if child + child_size > len(data):
+                    # Only the front of a file that is still arriving.
+                    return None
+                for entry_id, entry, entry_size in _ebml_elements(data, child, child + child_size):
+                    if entry_id == 0xAE:  # TrackEntry
+                        track = _video_track(data, entry, entry + entry_size)
+                        if track is not None:
+                            return track
+                return None
+    except (IndexError, ValueError):
+        pass
+    return None
+
+
+def _video_track(data: bytes, position: int, end: int) -> Optional[VideoTrack]:
+    fields = {}
+    for element_id, offset, size in _ebml_elements(data, position, end):
+        if element_id == 0xE0:  # Video
+            for video_id, value, value_size in _ebml_elements(data, offset, offset + size):
+                if video_id in (0xB0, 0xBA):  # PixelWidth, PixelHeight
+                    fields[video_id] = int.from_bytes(data[value:value + value_size], 'big')
+        elif element_id in (0x83, 0x86):  # TrackType, CodecID
+            fields[element_id] = data[offset:offset + size]
+        elif element_id == 0x23E383:  # DefaultDuration, nanoseconds per frame
+            fields[element_id] = int.from_bytes(data[offset:offset + size], 'big')
+    codec = MATROSKA_CODECS.get(fields.get(0x86, b'').decode('ascii', 'replace'))
+    if fields.get(0x83) != b'\x01' or codec is None or not fields.get(0xB0) or not fields.get(0xBA):
+        return None
+    frame_duration = fields.get(0x23E383)
+    return VideoTrack(codec, fields[0xB0], fields[0xBA], 1e9 / frame_duration if frame_duration else 0.0)
+
+
+def output_fps(track: Optional[VideoTrack], options: ConversionOptions) -> float:
+    """Frame rate to resample a video to, or 0 to keep its own.
+
+    Like :func:`select_frames`, ``target_fps`` only ever lowers the rate; a
+    source whose rate is unknown is resampled as asked.
+    """
+    if not options.target_fps or (track is not None and 0 < track.fps <= options.target_fps):
+        return 0.0
+    return options.target_fps
+
+
+class _Prefixed:
+    """``head`` followed by the rest of ``pieces``; aborting is passed on to ``source``."""
+
+    def __init__(self, head: List[bytes], pieces: Iterator[bytes], source: Iterable[bytes]):
+        self.__head = head
+        self.__pieces = pieces
+        self.__source = source
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield from self.__head
+        yield from self.__pieces
+
+    def abort(self):
+        abort = getattr(self.__source, 'abort', None)
+        if abort is not None:
+            abort()
+
+
+def _peek_video_track(pieces: Iterator[bytes]) -> Tuple[List[bytes], Optional[VideoTrack]]:
+    """Read pieces until the WebM header is complete; returns them with the track found."""
+    head = []
+    size = 0
+    for piece in pieces:
+        head.append(piece)
+        size += len(piece)
+        track = webm_video_track(b''.join(head))
+        if track is not None:
+            return head, track
+        if size >= VIDEO_HEADER_PEEK_BYTES:
+            break
+    return head, None
+
+
+@contextlib.contextmanager
+def _memory_file(data: bytes) -> Iterator[Optional[int]]:
+    """An anonymous in-memory file holding ``data``; ``None`` where memfd is unavailable."""
+    if not hasattr(os, 'memfd_create'):
+        yield None
+        return
+    fd = os.memfd_create('tgs-video-input')
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def iter_video(data: bytes, out_format: str, width: int, height: int,
+               options: ConversionOptions = DEFAULT_OPTIONS) -> Iterator[bytes]:
+    """Convert a complete video file.
+
+    ffmpeg reads it from a memfd rather than a pipe, so it can probe and seek
+    the input. When the codec already suits the output container and nothing
+    needs rescaling or resampling, the streams are copied without re-encoding.
+    """
+    track = webm_video_track(data)
+    fps = output_fps(track, options)
+    remux = (
+        track is not None
+        and track.codec in REMUX_CODECS.get(out_format, ())
+        and (width or track.width, height or track.height) == (track.width, track.height)
+        and not fps
+    )
+    with _memory_file(data) as fd:
+        if fd is None:
+            yield from _run_video('pipe:0', [data], out_format, width, height, fps, options, remux)
+        else:
+            yield from _run_video(f'/proc/self/fd/{fd}', (), out_format, width, height, fps, options, remux, (fd,))
+
+
+def iter_video_stream(pieces: Iterable[bytes], out_format: str, width: int, height: int,
+                      options: ConversionOptions = DEFAULT_OPTIONS) -> Iterator[bytes]:
+    """Like :func:`iter_video`, with the input fed to ffmpeg's stdin piece by piece as it arrives."""
+    track = None
+    if options.target_fps:
+        # The source frame rate is in the header, so hold back the first pieces until it is read.
+        rest = iter(pieces)
+        head, track = _peek_video_track(rest)
+        pieces = _Prefixed(head, rest, pieces)
+    yield from _run_video('pipe:0', pieces, out_format, width, height, output_fps(track, options), options,
+                          remux=False)
+
+
+def _run_video(source: str, pieces: Iterable[bytes], out_format: str, width: int, height: int, fps: float,
+               options: ConversionOptions, remux: bool, pass_fds: Tuple[int, ...] = ()) -> Iterator[bytes]:
+    output_args = {}
+    if options.max_duration_ms:
+        output_args['t'] = options.max_duration_ms / 1000
+    if options.max_frames:
+        output_args['vframes'] = options.max_frames
+    preset = TRANSCODE_PRESETS.get(out_format)
+    if remux:
+        # Stickers carry no audio; dropping any keeps codecs the container cannot hold out.
+        output_args.update(format=preset['format'] if preset else out_format, vcodec='copy', an=None)
+        if 'movflags' in (preset or {}).get('extra_args', {}):
+            output_args['movflags'] = preset['extra_args']['movflags']
+    else:
+        filters = [f'scale={width}:{height}']
+        if fps:
+            filters.append(f'fps={fps}')
+        output_args['vf'] = ','.join(filters)
+        if out_format in SEQUENCE_FORMATS:
+            output_args.update(format='image2pipe', vcodec='png')
+        elif preset is not None:
+            output_args.update(tier_args(preset['vcodec'], preset['extra_args'], options.encode_tier),
+                               format=preset['format'], vcodec=preset['vcodec'], pix_fmt=preset['pix_fmt'])
+        else:
+            output_args.update(format=out_format)
+    try:
+        stream = ffmpeg.input(source).output('pipe:1', **output_args).global_args('-loglevel', 'error')
+        if source != 'pipe:0':
+            stream = stream.global_args('-nostdin')
+        # Spawned directly rather than through run_async, which cannot pass the memfd on.
+        process = subprocess.Popen(stream.compile(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, pass_fds=pass_fds)
+        # ffmpeg decodes, scales and encodes in one go; that all counts as "encode".
+        encode = StageClock()
+        output = encode.wrap(stream_ffmpeg(process, pieces, out_format=out_format))
+        if out_format in SEQUENCE_FORMATS:
+            yield from zip_frames(split_png_stream(output))
+        else:
+            yield from output
+        encode.observe("encode", "video", out_format)
+    except Exception as e:
+        raise ConvertationError(f'Video conversion failed: {e}')
+
+
+def convert_video(data: bytes, out_format: str, width: int, height: int,
+                  options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
+    return b''.join(iter_video(data, out_format, width, height, options))
@@ -0,0 +1,399 @@
+"""Frame encoders for animated output.
+
+Every backend takes raw BGRA frames, as produced by rlottie, and yields the
+encoded file in pieces. The ffmpeg subprocess backend supports every animated
+format and is the fallback whenever a configured in-process backend is missing
+its library or does not handle the requested format.
+"""
+import abc
+import io
+import os
+import select
+import subprocess
+import threading
+import time
+from fractions import Fraction
+from os import environ
+from typing import Dict, Iterable, Iterator, List
+
+import ffmpeg
+
+from tgs_converter.engine import current_cancel_token
+from tgs_converter.errors import ConversionCancelled, ConvertationError
+from tgs_converter.metrics import FFMPEG_FAILURES
+from tgs_converter.options import CHUNK_SIZE
+
+FLUSH_DELAY = 0.05
+
+ENCODE_PRESETS = {
+    "mp4": {
+        "vcodec": "libx264",
+        "format": "mp4",
+        "pix_fmt": "yuv420p",
+        "extra_args": {
+            "movflags": "frag_keyframe+empty_moov",
+            "preset": "ultrafast",
+            "tune": "zerolatency",
+        },
+    },
+    "webm": {
+        "vcodec": "libvpx",
+        "format": "webm",
+        "pix_fmt": "yuv420p",
+        "extra_args": {
+            "b:v": "0",
+            "deadline": "realtime",
+            "cpu-used": "5",
+            "crf": "32"
+        },
+    },
+    "gif": {
+        "vcodec": None,
+        "format": "gif",
+        "pix_fmt": "rgb24",
+        "extra_args": {},
+    },
+}
+
+# The presets are the "fast" tier; the other tiers override some of their
+# arguments per codec, None dropping one. On 3 s of 512x512 frames the x264
+# quality tier takes about 1.8x as long for 35-40% of the size and VP9 about
+# 1.9x as long for 6% less. On rendered stickers VP8 at the "good" deadline
+# takes 1.4-2x as long as "realtime" for up to 75% less, but only from
+# cpu-used 3 down; at 4 and above it comes out larger than "realtime".
+ENCODE_TIER_ARGS = {
+    "libx264": {
+        "quality": {"preset": "veryfast", "tune": None},
+        "balanced": {"preset": "superfast"},
+    },
+    "libvpx": {
+        "quality": {"deadline": "good", "cpu-used": "2"},
+        "balanced": {"deadline": "good", "cpu-used": "3"},
+    },
+    "libvpx-vp9": {
+        "quality": {"cpu-used": "5"},
+        "balanced": {"cpu-used": "6"},
+    },
+}
+
+
+def tier_args(vcodec: str, args: Dict[str, str], tier: str) -> Dict[str, str]:
+    """``args`` with the overrides of ``tier`` for ``vcodec`` applied."""
+    args = dict(args)
+    for name, value in ENCODE_TIER_ARGS.get(vcodec, {}).get(tier, {}).items():
+        if value is None:
+            args.pop(name, None)
+        else:
+            args[name] = value
+    return args
+
+
+def read_coalesced(fd: int, chunk_size: int = CHUNK_SIZE, max_delay: float = FLUSH_DELAY) -> Iterator[bytes]:
+    """Read a pipe until EOF, yielding pieces of up to ``chunk_size`` bytes.
+
+    Encoders tend to write many tiny packets (a GIF frame can be a few dozen
+    bytes), so reads are batched until a full chunk is available or
+    ``max_delay`` seconds have passed since the first pending byte. Pieces are
+    joined once on the way out; a lone full read is passed on without a copy.
+    """
+    pending: List[bytes] = []
+    size = 0
+    deadline = 0.0
+    while True:
+        timeout = max(0.0, deadline - time.monotonic()) if pending else None
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if not ready:
+            yield _join(pending)
+            pending, size = [], 0
+            continue
+        data = os.read(fd, chunk_size - size)
+        if not data:
+            break
+        if not pending:
+            deadline = time.monotonic() + max_delay
+        pending.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield _join(pending)
+            pending, size = [], 0
+    if pending:
+        yield _join(pending)
+
+
+def _join(pieces: List[bytes]) -> bytes:
+    return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+
+def stream_ffmpeg(process: subprocess.Popen, inputs: Iterable[bytes], chunk_size: int = CHUNK_SIZE,
+                  out_format: str = "") -> Iterator[bytes]:
+    """Feed ``inputs`` to an ffmpeg child from a helper thread and yield its stdout as it arrives.
+
+    Closing the generator early, or cancelling the engine's token for this
+    conversion, kills ffmpeg and stops the feeder. ``inputs`` that may block
+    waiting for data (an :class:`~tgs_converter.engine.InputFeed`) are aborted
+    once ffmpeg is gone. Failed runs are counted per ``out_format``.
+    """
+    feed_errors = []
+    stop = threading.Event()
+    cancel = current_cancel_token()
+
+    def feed():
+        try:
+            for item in inputs:
+                if stop.is_set():
+                    break
+                process.stdin.write(item)
+        except BrokenPipeError:
+            # ffmpeg went away; its exit code and stderr explain why.
+            pass
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            # Release whatever the input generator holds (e.g. leased frame buffers) right away.
+            close = getattr(inputs, "close", None)
+            if close is not None:
+                close()
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    cancel.add_callback(process.kill)
+    completed = False
+    try:
+        yield from read_coalesced(process.stdout.fileno(), chunk_size)
+        completed = True
+    finally:
+        cancel.remove_callback(process.kill)
+        if not completed:
+            stop.set()
+            process.kill()
+        abort = getattr(inputs, "abort", None)
+        if abort is not None:
+            abort()
+        feeder.join()
+        err = process.stderr.read()
+        process.wait()
+
+    if cancel.cancelled():
+        raise ConversionCancelled('ffmpeg was stopped, the conversion was cancelled')
+    if feed_errors and isinstance(feed_errors[0], ConvertationError):
+        # Producing the input failed (bad frames, no memory budget); ffmpeg's complaint is only a symptom.
+        raise feed_errors[0]
+    if process.returncode != 0:
+        FFMPEG_FAILURES.inc(format=out_format)
+        raise ConvertationError(f'ffmpeg failed: {err.decode("utf-8")}')
+    if feed_errors:
+        FFMPEG_FAILURES.inc(format=out_format)
+        raise ConvertationError(f'ffmpeg failed: {feed_errors[0]}')
+
+
+class Encoder(abc.ABC):
+    """Encodes raw BGRA frames.
+
+    Frames may be reused buffers that are overwritten once the next frame is
+    requested, so a backend that keeps frames around must copy them.
+    """
+    name: str
+    formats: List[str]
+
+    def available(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def encode(self, frames: Iterable[bytes], out_format: str, width: int, height: int,
+               fps: float, frame_count: int, tier: str = "") -> Iterator[bytes]:
+        """``tier`` is one of ``ENCODE_TIERS``; backends without settings to trade ignore it."""
+        pass
+
+
+class SubprocessEncoder(Encoder):
+    """Pipes frames into a freshly spawned ``ffmpeg`` process."""
+    name = "ffmpeg"
+    formats = list(ENCODE_PRESETS)
+
+    def encode(self, frames: Iterable[bytes], out_format: str, width: int, height: int,
+               fps: float, frame_count: int, tier: str = "") -> Iterator[bytes]:
+        preset = ENCODE_PRESETS[out_format]
+        output_args = tier_args(preset["vcodec"], preset["extra_args"], tier)
+        if preset["vcodec"] is not None:
+            output_args["vcodec"] = preset["vcodec"]
+        try:
+            process = (
+                ffmpeg
+                .input(
+                    "pipe:0",
+                    format="rawvideo",
+                    pix_fmt="bgra",
+                    s=f"{width}x{height}",
+                    framerate=fps
+                )
+                .output(
+                    "pipe:1",
+                    format=preset["format"],
+                    pix_fmt=preset["pix_fmt"],
+                    vframes=frame_count,
+                    **output_args
+                )
+                .global_args("-loglevel", "error")
+                .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+            )
+        except Exception as e:
+            FFMPEG_FAILURES.inc(format=out_format)
+            raise ConvertationError(f'ffmpeg failed: {e}')
+
+        yield from stream_ffmpeg(process, frames, out_format=out_format)
+
+
+class ChunkSink:
+    """Write-only file object collecting muxer output until it is drained."""
+
+    def __init__(self):
+        self.__parts = []
+        self.__size = 0
+
+    def write(self, data) -> int:
+        self.__parts.append(bytes(data))
+        self.__size += len(data)
+        return len(data)
+
+    def pending(self) -> int:
+        return self.__size
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self.__parts)
+        self.__parts = []
+        self.__size = 0
+        return data
+
+
+class PyAVEncoder(Encoder):
+    """Encodes in-process through libav via PyAV, avoiding the fork/exec and pipe copies."""
+    name = "pyav"
+    formats = ["mp4", "webm", "gif"]
+
+    CODECS = {
+        "mp4": ("libx264", "yuv420p", {"preset": "ultrafast", "tune": "zerolatency"}),
+        "webm": ("libvpx", "yuv420p", {"b": "0", "deadline": "realtime", "cpu-used": "5", "crf": "32"}),
+        "gif": ("gif", "rgb8", {}),
+    }
+    CONTAINER_OPTIONS = {
+        "mp4": {"movflags": "frag_keyframe+empty_moov"},
+    }
+
+    def available(self) -> bool:
+        try:
+            import av  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def encode(self, frames: Iterable[bytes], out_format: str, width: int, height: int,
+               fps: float, frame_count: int, tier: str = "") -> Iterator[bytes]:
+        import av
+
+        codec, pix_fmt, options = self.CODECS[out_format]
+        options = tier_args(codec, options, tier)
+        sink = ChunkSink()
+        try:
+            container = av.open(sink, mode="w", format=out_format,
+                                options=self.CONTAINER_OPTIONS.get(out_format, {}))
+            stream = container.add_stream(codec, rate=Fraction(fps).limit_denominator(1001))
+            stream.width = width
+            stream.height = height
+            stream.pix_fmt = pix_fmt
+            stream.options = options
+        except Exception as e:
+            raise ConvertationError(f'libav encoder setup failed: {e}')
+
+        try:
+            for frame_bytes in frames:
+                for packet in stream.encode(self.__to_frame(av, frame_bytes, width, height)):
+                    container.mux(packet)
+                if sink.pending() >= CHUNK_SIZE:
+                    yield sink.drain()
+            for packet in stream.encode():
+                container.mux(packet)
+        except Exception as e:
+            raise ConvertationError(f'libav encoding failed: {e}')
+        finally:
+            container.close()
+        if sink.pending():
+            yield sink.drain()
+
+    @staticmethod
+    def __to_frame(av, frame_bytes: bytes, width: int, height: int):
+        frame = av.VideoFrame(width, height, "bgra")
+        plane = frame.planes[0]
+        row_size = width * 4
+        if plane.line_size == row_size:
+            plane.update(frame_bytes)
+        else:
+            view = memoryview(plane)
+            source = memoryview(frame_bytes)
+            for row in range(height):
+                view[row * plane.line_size:row * plane.line_size + row_size] = \
+                    source[row * row_size:(row + 1) * row_size]
+        return frame
+
+
+class PillowEncoder(Encoder):
+    """Builds animated GIFs with Pillow; the whole animation is assembled before it is written."""
+    name = "pillow"
+    formats = ["gif"]
+
+    def encode(self, frames: Iterable[bytes], out_format: str, width: int, height: int,
+               fps: float, frame_count: int, tier: str = "") -> Iterator[bytes]:
+        from PIL import Image
+
+        # frombytes copies, the frame buffers are reused by the renderer.
+        images = [
+            Image.frombytes('RGBA', (width, height), frame_bytes, 'raw', 'BGRA', 0, 1)
+            for frame_bytes in frames
+        ]
+        if not images:
+            raise ConvertationError("No frames to encode")
+        output = io.BytesIO()
+        images[0].save(
+            output,
+            format="GIF",
+            save_all=True,
+            append_images=images[1:],
+            duration=round(1000 / fps),
+            loop=0,
+            disposal=2,
+        )
+        yield output.getvalue()
+
+
+ENCODERS: Dict[str, Encoder] = {
+    encoder.name: encoder for encoder in (SubprocessEncoder(), PyAVEncoder(), PillowEncoder())
+}
+DEFAULT_ENCODER = ENCODERS["ffmpeg"]
+
+
+def parse_encoder_backends(spec: str) -> Dict[str, str]:
+    """Parse ``ENCODER_BACKENDS``, e.g. ``"gif=pillow,webm=pyav"``."""
+    backends = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        out_format, _, backend = item.partition("=")
+        backends[out_format.strip()] = backend.strip()
+    return backends
+
+
+ENCODER_BACKENDS = parse_encoder_backends(environ.get("ENCODER_BACKENDS", ""))
+
+
+def get_encoder(out_format: str, backend: str = None) -> Encoder:
+    name = backend or ENCODER_BACKENDS.get(out_format, DEFAULT_ENCODER.name)
+    encoder = ENCODERS.get(name)
+    if encoder is None or out_format not in encoder.formats or not encoder.available():
+        return DEFAULT_ENCODER
+    return encoder
@@ -0,0 +1,228 @@
+import asyncio
+import contextvars
+import ctypes
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from os import environ
+from typing import AsyncIterator, Callable, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class CancelToken:
+    """Tells work running on a worker thread that nobody wants its output any more.
+
+    Long loops poll :meth:`cancelled`; code blocked on something external, such
+    as a read from an ffmpeg child, registers a callback that unblocks it.
+    """
+
+    def __init__(self):
+        self.__event = threading.Event()
+        self.__callbacks: List[Callable[[], None]] = []
+        self.__lock = threading.Lock()
+
+    def cancelled(self) -> bool:
+        return self.__event.is_set()
+
+    def cancel(self):
+        with self.__lock:
+            if self.__event.is_set():
+                return
+            self.__event.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        with self.__lock:
+            if not self.__event.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self.__lock:
+            if callback in self.__callbacks:
+                self.__callbacks.remove(callback)
+
+
+_cancel_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar("cancel_token", default=None)
+
+
+def current_cancel_token() -> CancelToken:
+    """The token of the :meth:`ExecutionEngine.iterate` call running on this thread.
+
+    Outside of one a fresh token that is never cancelled is returned.
+    """
+    return _cancel_token.get() or CancelToken()
+
+
+class InputFeed:
+    """Hands items produced on the event loop to a blocking consumer on a worker thread.
+
+    The loop side calls :meth:`push` for every item and :meth:`finish` at the
+    end; iterating on the worker blocks until the next item arrives. The
+    consumer side may :meth:`abort` to stop waiting, e.g. once the process it
+    was feeding has exited.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self):
+        self.__queue = queue.SimpleQueue()
+        self.__end = object()
+        self.__aborted = threading.Event()
+
+    def push(self, item):
+        self.__queue.put((item, None))
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.__queue.put((self.__end, error))
+
+    def abort(self):
+        self.__aborted.set()
+
+    def __iter__(self) -> Iterator:
+        while not self.__aborted.is_set():
+            try:
+                item, error = self.__queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is self.__end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+
+
+PR_SET_PDEATHSIG = 1
+
+
+def _die_with_parent(parent_pid: int):
+    """Pool initializer: have the kernel kill the worker once the process that spawned it is gone.
+
+    Without this a server process that crashes leaves its pool workers running
+    under init.
+    """
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except (OSError, AttributeError):
+        # Not Linux; the supervisor still kills the process group.
+        return
+    if os.getppid() != parent_pid:
+        # The parent died before the signal was armed.
+        os._exit(1)
+
+
+class ExecutionEngine:
+    """Runs blocking conversion work off the event loop.
+
+    CPU-bound work (decompression, parsing, rendering, Pillow) goes to a pool of
+    spawned worker processes; subprocess I/O such as feeding ffmpeg goes to a
+    thread pool. With ``process_workers=0`` CPU work falls back to the thread
+    pool, which keeps everything in one process for debugging.
+    """
+
+    def __init__(self, process_workers: int, thread_workers: int):
+        self.process_workers = process_workers
+        self.thread_workers = thread_workers
+        self.__processes: Optional[Executor] = None
+        self.__threads: Optional[Executor] = None
+
+    @property
+    def threads(self) -> Executor:
+        if self.__threads is None:
+            self.__threads = ThreadPoolExecutor(self.thread_workers, thread_name_prefix="tgs-io")
+        return self.__threads
+
+    @property
+    def processes(self) -> Executor:
+        if self.process_workers <= 0:
+            return self.threads
+        if self.__processes is None:
+            # Forking a process that already runs grpc is unsafe, so always spawn.
+            self.__processes = ProcessPoolExecutor(self.process_workers,
+                                                   mp_context=multiprocessing.get_context("spawn"),
+                                                   initializer=_die_with_parent, initargs=(os.getpid(),))
+        return self.__processes
+
+    async def run_cpu(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.processes, fn, *args)
+
+    async def run_io(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.threads, fn, *args)
+
+    async def iterate(self, fn: Callable[..., Iterator[T]], *args, max_pending: int = 4) -> AsyncIterator[T]:
+        """Drive the sync generator ``fn(*args)`` on the thread pool and yield its items.
+
+        At most ``max_pending`` items are buffered before the worker thread blocks.
+        If the consumer stops early, the generator's :class:`CancelToken` is
+        cancelled and the generator is closed on its own thread, letting its
+        ``finally`` blocks tear down subprocesses.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(max_pending)
+        stop = CancelToken()
+        end = object()
+
+        def put(item, error=None):
+            asyncio.run_coroutine_threadsafe(queue.put((item, error)), loop).result()
+
+        def produce():
+            _cancel_token.set(stop)
+            try:
+                iterator = fn(*args)
+                try:
+                    for item in iterator:
+                        if stop.cancelled():
+                            return
+                        put(item)
+                        if stop.cancelled():
+                            return
+                finally:
+                    iterator.close()
+            except BaseException as e:
+                if not stop.cancelled():
+                    put(end, e)
+                return
+            if not stop.cancelled():
+                put(end)
+
+        # A copied context keeps the token from leaking into the pool thread.
+        loop.run_in_executor(self.threads, contextvars.copy_context().run, produce)
+        try:
+            while True:
+                item, error = await queue.get()
+                if item is end:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            stop.cancel()
+            # Unblock a producer waiting on a full queue so it can notice the stop.
+            while not queue.empty():
+                queue.get_nowait()
+
+    def shutdown(self, wait: bool = True):
+        if self.__processes is not None:
+            self.__processes.shutdown(wait=wait)
+            self.__processes = None
+        if self.__threads is not None:
+            self.__threads.shutdown(wait=wait)
+            self.__threads = None
+
+
+def build_engine() -> ExecutionEngine:
+    cpu_count = os.cpu_count() or 1
+    return ExecutionEngine(
+        process_workers=int(environ.get("ENGINE_PROCESS_WORKERS", str(cpu_count))),
+        thread_workers=int(environ.get("ENGINE_THREAD_WORKERS", str(cpu_count * 4))),
+    )
+
+
+engine = build_engine()
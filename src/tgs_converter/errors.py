@@ -0,0 +1,8 @@
+class ConvertationError(Exception):
+    """Custom exception to indicate failure during file convertation."""
+    pass
+
+
+class ConversionCancelled(ConvertationError):
+    """Raised inside a conversion whose consumer has gone away."""
+    pass
@@ -0,0 +1,123 @@
+"""Readiness reporting through the standard gRPC health service, and the start-up warm-up pass.
+
+The first conversion of each kind pays one-off costs: spawning the worker
+processes, loading rlottie and the codecs, the first ffmpeg launch. The
+warm-up pass converts built-in samples to every output format before the
+server reports SERVING, so load balancers only send traffic to warm workers.
+"""
+import asyncio
+import gzip
+import io
+import json
+import subprocess
+import time
+from typing import Dict, Tuple
+
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
+
+from tgs_converter.engine import ExecutionEngine
+from tgs_converter.server import SERVICE_NAME, asp, ssp, vsp
+
+# "" is the server as a whole; checkers may also ask for the converter service by name.
+HEALTH_SERVICES = ("", SERVICE_NAME)
+
+WARM_UP_FORMATS = {
+    "tgs": ["png", "jpg", "webp", "webm", "mp4", "gif", "png_sequence"],
+    "png": ["png", "jpg", "webp", "png_sequence"],
+    "webm": ["mp4", "mov", "webm", "gif", "webp", "png_sequence"],
+}
+WARM_UP_SIZE = 512
+
+
+def add_health_service(server) -> health.aio.HealthServicer:
+    servicer = health.aio.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(servicer, server)
+    return servicer
+
+
+async def set_serving(servicer: health.aio.HealthServicer, serving: bool):
+    status = health_pb2.HealthCheckResponse.SERVING if serving else health_pb2.HealthCheckResponse.NOT_SERVING
+    for service in HEALTH_SERVICES:
+        await servicer.set(service, status)
+
+
+def sample_tgs(frames: int = 30) -> bytes:
+    """A small rotating square; keyframes need easing handles or rlottie renders nothing."""
+    ease = {"x": [0.5], "y": [0.5]}
+    layer = {
+        "ty": 4, "ip": 0, "op": frames, "st": 0,
+        "ks": {
+            "o": {"a": 0, "k": 100},
+            "r": {"a": 1, "k": [{"t": 0, "s": [0], "i": ease, "o": ease}, {"t": frames, "s": [360]}]},
+            "p": {"a": 0, "k": [256, 256, 0]},
+            "a": {"a": 0, "k": [0, 0, 0]},
+            "s": {"a": 0, "k": [100, 100, 100]},
+        },
+        "shapes": [{"ty": "gr", "it": [
+            {"ty": "rc", "p": {"a": 0, "k": [0, 0]}, "s": {"a": 0, "k": [240, 240]}, "r": {"a": 0, "k": 24}},
+            {"ty": "fl", "o": {"a": 0, "k": 100}, "c": {"a": 0, "k": [0.2, 0.5, 1, 1]}},
+            {"ty": "tr", "p": {"a": 0, "k": [0, 0]}, "a": {"a": 0, "k": [0, 0]}, "s": {"a": 0, "k": [100, 100]},
+             "r": {"a": 0, "k": 0}, "o": {"a": 0, "k": 100}},
+        ]}],
+    }
+    lottie = {"v": "5.5.2", "fr": 30, "ip": 0, "op": frames, "w": 512, "h": 512, "layers": [layer]}
+    return gzip.compress(json.dumps(lottie).encode("utf-8"))
+
+
+def sample_png() -> bytes:
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGBA", (WARM_UP_SIZE, WARM_UP_SIZE), (0, 0, 0, 0))
+    ImageDraw.Draw(image).ellipse((64, 64, WARM_UP_SIZE - 64, WARM_UP_SIZE - 64), fill=(255, 128, 0, 255))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def sample_webm() -> bytes:
+    # Producing the sample is the first ffmpeg launch, which is part of the point.
+    result = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi",
+         "-i", f"testsrc2=size={WARM_UP_SIZE}x{WARM_UP_SIZE}:rate=30:duration=1",
+         "-c:v", "libvpx-vp9", "-deadline", "realtime", "-f", "webm", "pipe:1"],
+        capture_output=True, check=True,
+    )
+    return result.stdout
+
+
+async def warm_up(engine: ExecutionEngine) -> Dict[Tuple[str, str], str]:
+    """Convert every sample to each of its output formats; returns the failures by (input, output) format.
+
+    Conversions go through the same processor entry points as requests, and
+    enough of them run at once to start every worker process.
+    """
+    samples = {
+        "tgs": sample_tgs(),
+        "png": await engine.run_io(sample_png),
+        "webm": await engine.run_io(sample_webm),
+    }
+    processors = {"tgs": asp, "png": ssp, "webm": vsp}
+
+    async def convert(in_format: str, out_format: str):
+        processor = processors[in_format]
+        async for _ in processor.stream(samples[in_format], in_format, out_format, WARM_UP_SIZE, WARM_UP_SIZE):
+            pass
+
+    jobs = [(in_format, out_format) for in_format, formats in WARM_UP_FORMATS.items() for out_format in formats]
+    # Static TGS output runs on the process pool; one job per worker starts them all.
+    jobs += [("tgs", "png")] * max(0, engine.process_workers - 1)
+    results = await asyncio.gather(*(convert(*job) for job in jobs), return_exceptions=True)
+    return {job: str(result) for job, result in zip(jobs, results) if isinstance(result, BaseException)}
+
+
+async def run_warm_up(engine: ExecutionEngine):
+    print("Warming up converters...")
+    started = time.perf_counter()
+    try:
+        failures = await warm_up(engine)
+    except Exception as e:
+        print(f"Warm-up could not prepare its samples: {e}")
+        failures = {}
+    for (in_format, out_format), error in failures.items():
+        print(f"Warm-up conversion {in_format} -> {out_format} failed: {error}")
+    print(f"Warm-up finished in {time.perf_counter() - started:.1f}s.")
@@ -8,24 +8,102 @@ if generated_dir_path not in sys.path:
     sys.path.insert(0, generated_dir_path)
 
 import asyncio
+import signal
 import grpc.aio
 
-from tgs_converter.server import TelegramStickersConverterServicer
-from generated.telegram_stickers_converter.telegram_stickers_converter_pb2_grpc import add_StickerConverterServiceServicer_to_server
+from tgs_converter.server import TelegramStickersConverterServicer, add_to_server
+from tgs_converter.engine import engine
+from tgs_converter.bot import get_downloader
+from tgs_converter.cache import get_result_cache
+from tgs_converter.health import add_health_service, run_warm_up, set_serving
+from tgs_converter.metrics import Gauge, cache_collector, registry, start_metrics_server
+from tgs_converter.supervisor import Supervisor
 
 
-async def serve():
+SHUTDOWN_GRACE = float(environ.get("SHUTDOWN_GRACE_SECONDS", "30"))
+# Convert built-in samples before reporting SERVING; WARM_UP=0 skips it.
+WARM_UP = environ.get("WARM_UP", "1") != "0"
+
+
+async def serve(worker_index: int = 0):
     print("Async gRPC server starting...")
-    server = grpc.aio.server()
-    add_StickerConverterServiceServicer_to_server(
-        TelegramStickersConverterServicer(), server
-    )
+    max_rpcs = int(environ.get("MAX_CONCURRENT_RPCS", "0"))
+    # Past this gRPC itself answers RESOURCE_EXHAUSTED; per-class limits apply below it.
+    # SO_REUSEPORT lets the supervisor's workers all bind the same port.
+    server = grpc.aio.server(maximum_concurrent_rpcs=max_rpcs or None, options=[("grpc.so_reuseport", 1)])
+    servicer = TelegramStickersConverterServicer()
+    add_to_server(servicer, server)
+    health = add_health_service(server)
+    await set_serving(health, False)
     grpc_port = environ.get("GRPC_PORT", "50051")
 
+    register_metrics(servicer)
+    metrics_runner = None
+    metrics_port = int(environ.get("METRICS_PORT", "9100"))
+    if metrics_port:
+        # Every worker keeps its own registry, so each gets its own port.
+        metrics_runner = await start_metrics_server(metrics_port + worker_index)
+        print(f"Metrics available at port {metrics_port + worker_index}.")
+
     actual_port = server.add_insecure_port(f"[::]:{grpc_port}")
     await server.start()
     print(f"Server started at port {actual_port}.")
-    await server.wait_for_termination()
+
+    async def stop():
+        # Turn readiness off first so balancers stop routing here while requests drain.
+        await health.enter_graceful_shutdown()
+        await server.stop(SHUTDOWN_GRACE)
+
+    def drain():
+        print(f"Draining, waiting up to {SHUTDOWN_GRACE:g}s for in-flight requests...")
+        asyncio.ensure_future(stop())
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, drain)
+    if WARM_UP:
+        await run_warm_up(engine)
+    await set_serving(health, True)
+    print("Serving.")
+    try:
+        await server.wait_for_termination()
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        engine.shutdown(wait=False)
+
+
+def register_metrics(servicer: TelegramStickersConverterServicer):
+    registry.register(Gauge("tgs_conversions_in_flight", "Distinct conversions currently running.",
+                            function=servicer.in_flight))
+    registry.add_collector(cache_collector("result_cache", get_result_cache().stats))
+    registry.add_collector(cache_collector("raw_file_cache", lambda: {"memory": get_downloader().files.stats.snapshot()}))
+    registry.add_collector(cache_collector("animation_cache", animation_cache_stats))
+
+
+def animation_cache_stats() -> dict:
+    # Imported here so that scraping, not start-up, loads the conversion modules if no request has yet.
+    from tgs_converter.conversions import animation_cache
+
+    return {"memory": animation_cache.stats.snapshot()}
+
+
+def run_worker(worker_index: int):
+    asyncio.run(serve(worker_index))
+
 
 def main():
-    asyncio.run(serve())
\ No newline at end of file
+    if not environ.get("TELEGRAM_TOKEN"):
+        print("Please set TELEGRAM_TOKEN environment variable")
+        sys.exit(1)
+    workers = int(environ.get("WORKERS", "1"))
+    if workers <= 1:
+        asyncio.run(serve())
+        return
+    # Split the CPU pool between the workers unless it was sized explicitly.
+    environ.setdefault("ENGINE_PROCESS_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+    Supervisor(workers, run_worker, drain_timeout=SHUTDOWN_GRACE + 5).run()
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
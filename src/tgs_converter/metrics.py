@@ -0,0 +1,333 @@
+"""Minimal Prometheus-style metrics and profiling hooks.
+
+The registry is process-local and thread-safe; conversions running on the
+engine's threads record into it directly. Work shipped to the engine's worker
+processes is timed from the calling side instead.
+"""
+import contextlib
+import cProfile
+import os
+import threading
+import time
+from os import environ
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.__values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self.__values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self.__values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labels)
+        self.__values: Dict[Tuple[str, ...], float] = {}
+        self.__function = function
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.__values[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self.__values.get(self._key(labels), 0.0)
+
+    @contextlib.contextmanager
+    def track(self, **labels) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        if self.__function is not None:
+            lines.append(f"{self.name} {self.__function()}")
+            return lines
+        with self._lock:
+            for key, value in sorted(self.__values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: per-bucket (non-cumulative) counts plus +Inf, sum, count.
+        self.__values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self.__values.get(key)
+            if state is None:
+                state = self.__values[key] = [0.0] * (len(self.buckets) + 3)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q: float, **labels) -> float:
+        """Upper bucket bound below which a ``q`` fraction of observations fall."""
+        with self._lock:
+            state = self.__values.get(self._key(labels))
+            if not state or not state[-1]:
+                return 0.0
+            target = q * state[-1]
+            seen = 0.0
+            for i, bound in enumerate(self.buckets):
+                seen += state[i]
+                if seen >= target:
+                    return bound
+        return float("inf")
+
+    def count(self, **labels) -> float:
+        state = self.__values.get(self._key(labels))
+        return state[-1] if state else 0.0
+
+    def snapshot(self, **labels) -> List[float]:
+        """Per-bucket (non-cumulative) counts plus +Inf, then sum and count; for diffing two points in time."""
+        with self._lock:
+            state = self.__values.get(self._key(labels))
+            return list(state) if state else [0.0] * (len(self.buckets) + 3)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, state in sorted(self.__values.items()):
+                cumulative = 0.0
+                for i, bound in enumerate(self.buckets):
+                    cumulative += state[i]
+                    labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {state[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {state[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {state[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.__metrics: List[_Metric] = []
+        self.__collectors: List[Callable[[], List[str]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.__metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], List[str]]):
+        """Register a callback producing exposition lines at scrape time."""
+        self.__collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render())
+        for collector in self.__collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    "tgs_requests_total", "Finished conversions by processor, output format and status.",
+    ["processor", "format", "status"]))
+REQUEST_DURATION = registry.register(Histogram(
+    "tgs_request_duration_seconds", "Wall time of a conversion request, first call to last chunk.",
+    ["processor", "format"]))
+STAGE_DURATION = registry.register(Histogram(
+    "tgs_stage_duration_seconds",
+    "Time spent per request stage: get_file, download, parse, render, encode, convert, stream.",
+    ["stage", "processor", "format"]))
+IN_FLIGHT = registry.register(Gauge(
+    "tgs_requests_in_flight", "RPCs currently being served.", ["method"]))
+FFMPEG_FAILURES = registry.register(Counter(
+    "tgs_ffmpeg_failures_total", "ffmpeg runs that exited with an error.", ["format"]))
+FRAME_BUFFER_BYTES = registry.register(Gauge(
+    "tgs_frame_buffer_bytes", "Raw frame buffer memory, leased to conversions or idle in the pool.", ["state"]))
+ADMISSION_ACTIVE = registry.register(Gauge(
+    "tgs_admission_active", "Conversions holding a concurrency slot.", ["processor"]))
+ADMISSION_WAITING = registry.register(Gauge(
+    "tgs_admission_waiting", "Conversions queued for a concurrency slot.", ["processor"]))
+ADMISSION_REJECTED = registry.register(Counter(
+    "tgs_admission_rejected_total", "Conversions turned away by admission control.", ["processor", "reason"]))
+ENCODE_TIER = registry.register(Counter(
+    "tgs_encode_tier_total", "Video encodes by the encoder settings tier picked for them.",
+    ["processor", "format", "tier"]))
+ENCODE_TIER_LEVEL = registry.register(Gauge(
+    "tgs_encode_tier_level", "Tier picked for the latest video encode: 0 quality, 1 balanced, 2 fast.",
+    ["processor"]))
+
+
+def cache_collector(name: str, stats: Callable[[], Dict[str, Dict[str, int]]]) -> Callable[[], List[str]]:
+    """Expose ``{tier: {hits, misses, evictions}}`` cache stats as counters."""
+    def collect() -> List[str]:
+        lines = []
+        for field in ("hits", "misses", "evictions"):
+            metric = f"tgs_{name}_{field}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for tier, values in sorted(stats().items()):
+                lines.append(f'{metric}{{tier="{tier}"}} {values[field]}')
+        return lines
+    return collect
+
+
+@contextlib.contextmanager
+def stage(name: str, processor: str, out_format: str) -> Iterator[None]:
+    with STAGE_DURATION.time(stage=name, processor=processor, format=out_format):
+        yield
+
+
+class StageClock:
+    """Accumulates the time spent producing the items of a lazily evaluated stage.
+
+    Only time inside ``next()`` counts, so consumers that stall (a slow client,
+    a full queue) do not inflate the stage being measured.
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def wrap(self, iterable: Iterable) -> Iterator:
+        iterator = iter(iterable)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.seconds += time.perf_counter() - started
+                yield item
+        finally:
+            # Propagate an early close so wrapped pipelines shut down promptly.
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    def observe(self, name: str, processor: str, out_format: str, seconds: Optional[float] = None):
+        STAGE_DURATION.observe(self.seconds if seconds is None else seconds,
+                               stage=name, processor=processor, format=out_format)
+
+
+PROFILE_DIR = environ.get("PROFILE_FRAME_LOOP_DIR")
+# Only one cProfile profiler may be active at a time on newer interpreters, so
+# concurrent conversions are sampled rather than all profiled.
+_profile_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def profile_frame_loop(label: str) -> Iterator[None]:
+    """Profile the enclosed frame loop with cProfile when ``PROFILE_FRAME_LOOP_DIR`` is set.
+
+    One ``.prof`` file per profiled conversion is written, loadable with ``pstats``
+    or snakeviz. The profiler only sees the thread that runs the loop.
+    """
+    if not PROFILE_DIR or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        filename = f"{label}-{os.getpid()}-{time.time_ns()}.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+    finally:
+        _profile_lock.release()
+
+
+async def start_metrics_server(port: int):
+    """Serve ``/metrics`` over HTTP; returns the aiohttp runner so callers can clean it up."""
+    from aiohttp import web
+
+    async def handle(_request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    return runner
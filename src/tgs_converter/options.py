@@ -0,0 +1,46 @@
+"""Output formats, output chunk size and per-request conversion options.
+
+Kept apart from :mod:`tgs_converter.conversions` so the server can parse
+requests without loading Pillow, rlottie and ffmpeg.
+"""
+from typing import NamedTuple, Optional
+
+# Size of the pieces output is produced and sent in.
+CHUNK_SIZE = 2 ** 18
+
+ANIMATED_FORMATS = ['webm', 'mp4', 'gif']
+STATIC_FORMATS = ['png', 'jpg', 'webp']
+SEQUENCE_FORMATS = ['png_sequence']
+
+# Encoder settings tiers, from best compression to fastest. Formats listed in
+# ENCODE_TIER_FORMATS have an ffmpeg/libav preset per tier.
+ENCODE_TIERS = ['quality', 'balanced', 'fast']
+ENCODE_TIER_FORMATS = ['webm', 'mp4', 'mov']
+
+
+class ConversionOptions(NamedTuple):
+    """Optional per-request conversion knobs; a field left at its default is "not set".
+
+    ``quality``, ``webp_method`` and ``png_compress_level`` trade encoding speed
+    for output size in the Pillow encoders; unset, Pillow's defaults apply.
+    ``encode_tier`` is picked by the server from its load rather than asked
+    for; unset, video encoders use the fast tier.
+    """
+    target_fps: float = 0.0
+    max_duration_ms: int = 0
+    max_frames: int = 0
+    quality: int = 0
+    webp_method: Optional[int] = None
+    png_compress_level: Optional[int] = None
+    encode_tier: str = ''
+
+    def cache_variant(self) -> str:
+        # Every tier encodes the same frames, so their results are interchangeable.
+        return ",".join(f"{name}={value}" for name, value in self._asdict().items()
+                        if value != self._field_defaults[name] and name != 'encode_tier')
+
+    def has_encoder_settings(self) -> bool:
+        return bool(self.quality) or self.webp_method is not None or self.png_compress_level is not None
+
+
+DEFAULT_OPTIONS = ConversionOptions()
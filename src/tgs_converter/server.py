@@ -1,185 +1,171 @@
 import abc
 import asyncio
-import gzip
-import io
-import json
-import ffmpeg
-import grpc
+import hashlib
+import math
+import time
+from os import environ
+from typing import AsyncIterator, List, NamedTuple, Optional
 
-from PIL import Image
+import grpc
 
 from generated.telegram_stickers_converter.telegram_stickers_converter_pb2 import OutputFormat, GetStickerRequest, \
-    StickerFileMetadata, StickerFileChunk
+    StickerFileMetadata, StickerFileChunk, GetStickerSetRequest, StickerSetItem, StickerInSetHeader, \
+    StickerProcessingError
 from generated.telegram_stickers_converter import telegram_stickers_converter_pb2_grpc
-from tgs_converter.bot import bot
-from rlottie_python import LottieAnimation
+from tgs_converter.bot import TelegramDownloader, get_downloader
+from tgs_converter.cache import ResultCache, get_result_cache, make_cache_key, content_hash
+from tgs_converter.singleflight import SingleFlight
+from tgs_converter.options import CHUNK_SIZE, ConversionOptions, DEFAULT_OPTIONS, ENCODE_TIER_FORMATS, STATIC_FORMATS
+from tgs_converter.engine import ExecutionEngine, InputFeed, engine as default_engine
+from tgs_converter.admission import AdmissionRejected, ConcurrencyLimiter, build_ladder, build_limiter
+from tgs_converter.metrics import IN_FLIGHT, REQUESTS, REQUEST_DURATION, STAGE_DURATION, stage
 
 
+# The conversion routines are imported where they are first used: they load
+# Pillow, rlottie and ffmpeg, which the server does not need to start.
 class StickerProcessor(abc.ABC):
+    name: str
+    output_formats: List[str]
+
+    def __init__(self, engine: ExecutionEngine = default_engine, limiter: Optional[ConcurrencyLimiter] = None):
+        self.engine = engine
+        self.limiter = limiter or build_limiter(self.name)
+        self.ladder = build_ladder(self.limiter)
+
+    def with_encode_tier(self, options: ConversionOptions, out_format: str) -> ConversionOptions:
+        """Pick the encoder settings tier for the current load, for formats that have tiers."""
+        if out_format not in ENCODE_TIER_FORMATS or options.encode_tier:
+            return options
+        return options._replace(encode_tier=self.ladder.choose(out_format))
+
+    def supports(self, out_format: str) -> bool:
+        return out_format in self.output_formats
+
     @abc.abstractmethod
-    async def process(self, data: bytes, in_format: str, out_format: str, width: int, height: int) -> bytes:
+    async def process(self, data: bytes, in_format: str, out_format: str, width: int, height: int,
+                      options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
         pass
 
+    async def stream(self, data: bytes, in_format: str, out_format: str, width: int, height: int,
+                     options: ConversionOptions = DEFAULT_OPTIONS) -> AsyncIterator[bytes]:
+        """Yield the converted file in pieces as they are produced."""
+        yield await self.process(data, in_format, out_format, width, height, options)
+
 
 class AnimatedStickersProcessor(StickerProcessor):
-    __allowed_output_formats = ['png', 'jpg', 'webp', 'webm', 'mp4', 'gif']
-    __animated = ['webm', 'mp4', 'gif']
-    __static = ['png', 'jpg', 'webp']
+    name = 'animated'
+    output_formats = ['png', 'jpg', 'webp', 'webm', 'mp4', 'gif', 'png_sequence']
 
-    async def process(self, data: bytes, in_format: str, out_format: str, width: int, height: int) -> bytes:
+    def __check(self, in_format: str, out_format: str):
         if in_format != 'tgs':
             raise ValueError('Only TGS format is supported for animated stickers')
-        if out_format not in self.__allowed_output_formats:
+        if not self.supports(out_format):
             raise ValueError(f'Unsupported output format: {out_format}')
-        unzipped = gzip.decompress(data)
-        lottie_json = json.loads(unzipped.decode('utf-8'))
-        animation = LottieAnimation.from_data(json.dumps(lottie_json))
 
-        if out_format in self.__animated:
-            total_frames = animation.lottie_animation_get_totalframe()
-            try:
-                ENCODE_PRESETS = {
-                    "mp4": {
-                        "vcodec": "libx264",
-                        "format": "mp4",
-                        "pix_fmt": "yuv420p",
-                        "extra_args": {
-                            "movflags": "frag_keyframe+empty_moov",
-                            "preset": "ultrafast",
-                            "tune": "zerolatency",
-                        },
-                    },
-                    "webm": {
-                        "vcodec": "libvpx",
-                        "format": "webm",
-                        "pix_fmt": "yuv420p",
-                        "extra_args": {
-                            "b:v": "0",
-                            "deadline": "realtime",
-                            "cpu-used": "5",
-                            "crf": "32"
-                        },
-                    },
-                    "gif": {
-                        "vcodec": None,
-                        "format": "gif",
-                        "pix_fmt": "rgb24",
-                        "extra_args": {},
-                    },
-                }
-
-                preset = ENCODE_PRESETS[out_format]
-                process = (
-                    ffmpeg
-                    .input(
-                        "pipe:0",
-                        format="rawvideo",
-                        pix_fmt="bgra",
-                        s=f"{width}x{height}",
-                        framerate=animation.lottie_animation_get_framerate()
-                    )
-                    .output(
-                        "pipe:1",
-                        format=preset["format"],
-                        vcodec=preset["vcodec"],
-                        pix_fmt=preset["pix_fmt"],
-                        vframes=total_frames,
-                        **preset["extra_args"],
-                        shortest=None
-                    )
-                    .global_args("-loglevel", "error")
-                    .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
-                )
-
-                for i in range(total_frames):
-                    print("1111")
-
-                    frame_bytes = animation.lottie_animation_render(
-                        frame_num=i, width=width, height=height
-                    )
-                    if len(frame_bytes) != width * height * 4:
-                        raise ConvertationError("Frame size mismatch")
-                    process.stdin.write(frame_bytes)
-
-                process.stdin.close()
-                out_data, err = await asyncio.get_running_loop().run_in_executor(
-                    None, process.communicate
-                )
-
-                if process.returncode != 0:
-                    raise ConvertationError(f'ffmpeg failed: {err.decode("utf-8")}')
-                return out_data
-            except Exception as e:
-                raise ConvertationError(f'ffmpeg failed: {e}')
-
-        if out_format in self.__static:
-            buffer = animation.lottie_animation_render(0, width=width, height=height)
-            image = Image.frombuffer('RGBA', (width, height), buffer, 'raw', 'BGRA')
-            output = io.BytesIO()
-            image.save(output, format=out_format.upper())
-
-            return output.getvalue()
-
-        raise ConvertationError("Unsupported output format")
+    async def process(self, data: bytes, in_format: str, out_format: str, width: int, height: int,
+                      options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
+        from tgs_converter.conversions import convert_animated
+
+        self.__check(in_format, out_format)
+        options = self.with_encode_tier(options, out_format)
+        return await self.engine.run_cpu(convert_animated, data, out_format, width, height, options)
+
+    async def stream(self, data: bytes, in_format: str, out_format: str, width: int, height: int,
+                     options: ConversionOptions = DEFAULT_OPTIONS) -> AsyncIterator[bytes]:
+        from tgs_converter.conversions import convert_animated, iter_animated
+
+        self.__check(in_format, out_format)
+        if out_format in STATIC_FORMATS:
+            # Worker processes keep their own metrics, so time the call from here.
+            with stage('convert', self.name, out_format):
+                result = await self.engine.run_cpu(convert_animated, data, out_format, width, height, options)
+            yield result
+            return
+        # rlottie releases the GIL while rendering and ffmpeg encodes in its own
+        # process, so the streaming pipeline runs on the I/O threads.
+        options = self.with_encode_tier(options, out_format)
+        async for chunk in self.engine.iterate(iter_animated, data, out_format, width, height, options):
+            yield chunk
 
 
 class StaticStickerProcessor(StickerProcessor):
-    __allowed_output_formats = ['png', 'jpg', 'webp']
+    name = 'static'
+    output_formats = ['png', 'jpg', 'webp', 'png_sequence']
+
+    async def process(self, data: bytes, in_format: str, out_format: str, width: int, height: int,
+                      options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
+        from tgs_converter.conversions import can_pass_through, convert_static
 
-    async def process(self, data: bytes, in_format: str, out_format: str, width: int, height: int) -> bytes:
         if in_format not in ('png', 'webp'):
             raise ValueError(f'Unsupported static format: {in_format}')
-        if out_format not in self.__allowed_output_formats:
+        if not self.supports(out_format):
             raise ValueError(f'Unsupported output format: {out_format}')
-
-        image = Image.open(io.BytesIO(data)).convert('RGBA')
-        if width and height:
-            image = image.resize((width, height))
-
-        output = io.BytesIO()
-        image.save(output, format=out_format.upper())
-        return output.getvalue()
+        with stage('convert', self.name, out_format):
+            if can_pass_through(data, in_format, out_format, width, height, options):
+                # Downloads arrive as bytearray, which protobuf does not accept.
+                return bytes(data)
+            return await self.engine.run_cpu(convert_static, data, out_format, width, height, options)
 
 
 class VideoStickerProcessor(StickerProcessor):
-    __allowed_output_formats = ['mp4', 'mpeg', 'gif', 'webm', 'mov', 'webp']
+    name = 'video'
+    output_formats = ['mp4', 'mpeg', 'gif', 'webm', 'mov', 'webp', 'png_sequence']
 
-    async def process(self, data: bytes, in_format: str, out_format: str, width: int, height: int) -> bytes:
+    def __check(self, in_format: str, out_format: str):
         if in_format != 'webm':
             raise ValueError('Only webm is supported as input format for video stickers')
-        if out_format not in self.__allowed_output_formats:
+        if not self.supports(out_format):
             raise ValueError(f'Unsupported output format: {out_format}')
 
-        input_stream = io.BytesIO(data)
-        output = io.BytesIO()
+    async def process(self, data: bytes, in_format: str, out_format: str, width: int, height: int,
+                      options: ConversionOptions = DEFAULT_OPTIONS) -> bytes:
+        from tgs_converter.conversions import convert_video
 
-        try:
-            process = (
-                ffmpeg
-                .input('pipe:0')
-                .output('pipe:1', format=out_format, vf=f'scale={width}:{height}')
-                .global_args('-loglevel', 'error')
-                .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
-            )
+        self.__check(in_format, out_format)
+        options = self.with_encode_tier(options, out_format)
+        # ffmpeg does the heavy lifting in its own process; we only shuttle bytes.
+        return await self.engine.run_io(convert_video, data, out_format, width, height, options)
 
-            loop = asyncio.get_running_loop()
-            input_bytes = input_stream.read()
-            out_data, err = await loop.run_in_executor(
-                None, lambda: process.communicate(input=input_bytes)
-            )
-            if process.returncode != 0:
-                raise ConvertationError(f'ffmpeg failed: {err.decode("utf-8")}')
-            return out_data
-        except Exception as e:
-            raise ConvertationError(f'Video conversion failed: {e}')
+    async def stream(self, data: bytes, in_format: str, out_format: str, width: int, height: int,
+                     options: ConversionOptions = DEFAULT_OPTIONS) -> AsyncIterator[bytes]:
+        from tgs_converter.conversions import iter_video
+
+        self.__check(in_format, out_format)
+        options = self.with_encode_tier(options, out_format)
+        async for chunk in self.engine.iterate(iter_video, data, out_format, width, height, options):
+            yield chunk
+
+    async def stream_input(self, feed: InputFeed, in_format: str, out_format: str, width: int, height: int,
+                           options: ConversionOptions = DEFAULT_OPTIONS) -> AsyncIterator[bytes]:
+        """Like :meth:`stream`, with the input still arriving through ``feed``."""
+        from tgs_converter.conversions import iter_video_stream
+
+        self.__check(in_format, out_format)
+        options = self.with_encode_tier(options, out_format)
+        async for chunk in self.engine.iterate(iter_video_stream, feed, out_format, width, height, options):
+            yield chunk
 
 
+STICKER_SET_PARALLELISM = int(environ.get("STICKER_SET_PARALLELISM", "8"))
+
 asp = AnimatedStickersProcessor()
 ssp = StaticStickerProcessor()
 vsp = VideoStickerProcessor()
 
 
-def infer_sticker_type(request: GetStickerRequest, data: bytes) -> str:
+def split_chunks(data: bytes):
+    if len(data) <= CHUNK_SIZE:
+        yield data
+        return
+
+    chunks_count = (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    for i in range(chunks_count):
+        start = i * CHUNK_SIZE
+        end = start + CHUNK_SIZE
+        yield data[start:end]
+
+
+def infer_sticker_type(request, data: bytes) -> str:
     if request.is_animated:
         return 'tgs'
     if request.is_video:
@@ -201,8 +187,8 @@ class GetFileError(Exception):
     pass
 
 
-class ConvertationError(Exception):
-    """Custom exception to indicate failure during file convertation."""
+class UploadTooLarge(ValueError):
+    """A ConvertBytes upload went past ``MAX_UPLOAD_BYTES``."""
     pass
 
 
@@ -212,7 +198,8 @@ CONTENT_TYPES = {
     "jpg": "image/jpeg",
     "mp4": "video/mp4",
     "webm": "video/webm",
-    "gif": "image/gif"
+    "gif": "image/gif",
+    "png_sequence": "application/zip",
 }
 
 OUTPUT_FORMAT_PROTO_MAP = {
@@ -222,6 +209,7 @@ OUTPUT_FORMAT_PROTO_MAP = {
     "mp4": OutputFormat.OUTPUT_FORMAT_MP4,
     "webm": OutputFormat.OUTPUT_FORMAT_WEBM,
     "gif": OutputFormat.OUTPUT_FORMAT_GIF,
+    "png_sequence": OutputFormat.OUTPUT_FORMAT_PNG_SEQUENCE,
 }
 
 def output_format_to_str(output_format: OutputFormat) -> str:
@@ -233,100 +221,565 @@ def output_format_to_str(output_format: OutputFormat) -> str:
         OutputFormat.OUTPUT_FORMAT_WEBM: 'webm',
         OutputFormat.OUTPUT_FORMAT_SVG: 'svg',
         OutputFormat.OUTPUT_FORMAT_TGS_RAW: 'tgs',
-        OutputFormat.OUTPUT_FORMAT_PNG_SEQUENCE: 'png',
+        OutputFormat.OUTPUT_FORMAT_PNG_SEQUENCE: 'png_sequence',
         OutputFormat.OUTPUT_FORMAT_JPG: "jpg",
         OutputFormat.OUTPUT_FORMAT_MP4: "mp4"
     }
     return x[output_format]
 
 
+class ConversionJob(NamedTuple):
+    """Everything that determines a conversion's output; doubles as the single-flight key."""
+    file_id: str
+    is_animated: bool
+    is_video: bool
+    out_format: str
+    width: int
+    height: int
+    options: ConversionOptions = DEFAULT_OPTIONS
+
+
+# GetStickerRequest belongs to the shared proto contract, so optional knobs
+# that are specific to this service travel as request metadata instead.
+OPTION_METADATA_KEYS = {
+    "x-target-fps": ("target_fps", float),
+    "x-max-duration-ms": ("max_duration_ms", int),
+    "x-max-frames": ("max_frames", int),
+    "x-quality": ("quality", int),
+    "x-webp-method": ("webp_method", int),
+    "x-png-compress-level": ("png_compress_level", int),
+}
+
+OPTION_RANGES = {
+    # The rate is only ever lowered, so the top merely rules out nonsense.
+    "target_fps": (1, 240),
+    "quality": (1, 100),
+    "webp_method": (0, 6),
+    "png_compress_level": (0, 9),
+}
+
+
+def parse_conversion_options(metadata) -> ConversionOptions:
+    values = {}
+    for key, value in metadata or ():
+        option = OPTION_METADATA_KEYS.get(key)
+        if option is None:
+            continue
+        name, parse = option
+        try:
+            values[name] = parse(value)
+        except ValueError:
+            raise ValueError(f'Invalid value for {key}: {value!r}')
+        if not math.isfinite(values[name]):
+            raise ValueError(f'Invalid value for {key}: {value!r}')
+        if values[name] < 0:
+            raise ValueError(f'{key} must not be negative')
+        if name in OPTION_RANGES:
+            low, high = OPTION_RANGES[name]
+            if not low <= values[name] <= high:
+                raise ValueError(f'{key} must be between {low} and {high}')
+    return ConversionOptions(**values)
+
+
+# ConvertBytes is not in the shared proto contract, so it is served through an
+# extra generic handler on the same service and reuses its messages: the client
+# streams StickerFileChunk messages, the first carrying StickerFileMetadata
+# (content_type hints the input format, actual_format is the desired output)
+# and the rest the file in data_chunk pieces. Size and conversion options
+# travel as request metadata, like GetSticker's options.
+SERVICE_NAME = 'telegram_stickers_converter.StickerConverterService'
+
+INPUT_FORMAT_HINTS = {
+    'tgs': 'tgs',
+    'application/x-tgsticker': 'tgs',
+    'webm': 'webm',
+    'video/webm': 'webm',
+    'png': 'png',
+    'image/png': 'png',
+    'webp': 'webp',
+    'image/webp': 'webp',
+}
+
+# Animated stickers have no intrinsic raster size; Telegram renders them at 512x512.
+DEFAULT_ANIMATED_SIZE = 512
+
+GZIP_MAGIC = b'\x1f\x8b'
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+# Enough leading bytes to recognise every supported input format.
+SNIFF_BYTES = 16
+# Inputs other than WebM are held in memory until complete, before any slot is taken.
+MAX_UPLOAD_BYTES = int(environ.get("MAX_UPLOAD_BYTES", str(16 * 2 ** 20)))
+
+
+class InputHint(NamedTuple):
+    is_animated: bool
+    is_video: bool
+
+
+def infer_input_format(content_type: str, head: bytes) -> str:
+    """Resolve an uploaded file's format from its leading bytes, which must agree with the client's hint if any."""
+    hint = None
+    if content_type:
+        hint = INPUT_FORMAT_HINTS.get(content_type.strip().lower())
+        if hint is None:
+            raise ValueError(f'Unsupported input content type: {content_type}')
+    try:
+        detected = infer_sticker_type(InputHint(head.startswith(GZIP_MAGIC), head.startswith(EBML_MAGIC)), head)
+    except ValueError:
+        if hint is None:
+            raise
+        raise ValueError(f'The uploaded data is not {hint}')
+    if hint is not None and hint != detected:
+        raise ValueError(f'Content type {content_type} does not match the uploaded data, which is {detected}')
+    return detected
+
+
+def check_upload_size(size: int):
+    if size > MAX_UPLOAD_BYTES:
+        raise UploadTooLarge(f'The upload is larger than {MAX_UPLOAD_BYTES} bytes')
+
+
+def parse_size(metadata) -> tuple:
+    size = {'x-width': 0, 'x-height': 0}
+    for key, value in metadata or ():
+        if key in size:
+            try:
+                size[key] = int(value)
+            except ValueError:
+                raise ValueError(f'Invalid value for {key}: {value!r}')
+            if size[key] < 0:
+                raise ValueError(f'{key} must not be negative')
+    return size['x-width'], size['x-height']
+
+
 class TelegramStickersConverterServicer(telegram_stickers_converter_pb2_grpc.StickerConverterServiceServicer):
+    def __init__(self, downloader: Optional[TelegramDownloader] = None,
+                 sticker_set_parallelism: int = STICKER_SET_PARALLELISM, results: Optional[ResultCache] = None):
+        self.__downloader = downloader or get_downloader()
+        self.__results = results or get_result_cache()
+        self.__conversions = SingleFlight()
+        self.__sticker_set_parallelism = sticker_set_parallelism
+
+    def in_flight(self) -> int:
+        """Number of distinct conversions currently running."""
+        return self.__conversions.in_flight()
+
     async def GetSticker(self, request: GetStickerRequest, context: grpc.aio.ServicerContext):
-        print("incoming ;)")
+        with IN_FLIGHT.track(method='GetSticker'):
+            async for chunk in self.__get_sticker(request, context):
+                yield chunk
+
+    async def __get_sticker(self, request: GetStickerRequest, context: grpc.aio.ServicerContext):
         try:
-            file_info = await self.__get_file_info(request.sticker_file_id, context)
-            byte_array = await file_info.download_as_bytearray()
-            file_bytes = bytes(byte_array)
-        except (GetFileError, FileDownloadError) as e:
-            print(f"Error fetching file: {e}")
+            options = parse_conversion_options(context.invocation_metadata())
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
             return
 
+        started = time.perf_counter()
+        deadline = self.__deadline(context)
+        job = None
+        status = 'error'
         try:
-            processor = (
-                asp if request.is_animated else
-                vsp if request.is_video else
-                ssp
+            job = ConversionJob(
+                file_id=request.sticker_file_id,
+                is_animated=request.is_animated,
+                is_video=request.is_video,
+                out_format=output_format_to_str(request.desired_format),
+                width=request.width,
+                height=request.height,
+                options=options,
             )
-            in_format = infer_sticker_type(request, file_bytes)
-            out_format = output_format_to_str(request.desired_format)
-
-            async for chunk in self.__run_process_and_stream(processor, file_bytes, in_format, out_format,
-                                                             request.width, request.height,
-                                                             request.sticker_file_id):
+            async for chunk in self.__send(job, self.__stream_job(job, deadline)):
                 yield chunk
-
+            status = 'ok'
+        except (asyncio.CancelledError, GeneratorExit):
+            status = 'cancelled'
+            raise
+        except AdmissionRejected as e:
+            status = 'rejected'
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details(str(e))
+            return
+        except (GetFileError, FileDownloadError) as e:
+            print(f"Error fetching file: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return
         except Exception as e:
             print(f"Processing error: {e}")
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details(f"Processing error: {str(e)}")
             return
+        finally:
+            if job is not None:
+                self.__observe(job, started, status)
+
+    async def GetStickerSet(self, request: GetStickerSetRequest, context: grpc.aio.ServicerContext):
+        with IN_FLIGHT.track(method='GetStickerSet'):
+            async for item in self.__get_sticker_set(request, context):
+                yield item
+
+    async def __get_sticker_set(self, request: GetStickerSetRequest, context: grpc.aio.ServicerContext):
+        try:
+            options = parse_conversion_options(context.invocation_metadata())
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return
 
-    async def __get_file_info(self, file_id: str, context: grpc.ServicerContext):
         try:
-            file_info = await bot.get_file(file_id=file_id)
+            sticker_set = await self.__downloader.bot.get_sticker_set(name=request.sticker_set_name)
+            out_format = output_format_to_str(request.desired_format_for_all)
         except Exception as e:
-            print(f"Error getting file info from Telegram: {e}")
+            print(f"Error getting sticker set: {e}")
             context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(f"Error getting file info: {e}")
-            raise GetFileError
+            context.set_details(f"Error getting sticker set: {e}")
+            return
+
+        deadline = self.__deadline(context)
+        semaphore = asyncio.Semaphore(self.__sticker_set_parallelism)
+        ready = asyncio.Queue()
+
+        async def convert(sticker):
+            job = ConversionJob(
+                file_id=sticker.file_id,
+                is_animated=sticker.is_animated,
+                is_video=sticker.is_video,
+                out_format=out_format,
+                width=sticker.width,
+                height=sticker.height,
+                options=options,
+            )
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    data = [piece async for piece in self.__stream_job(job, deadline)]
+                except Exception as e:
+                    self.__observe(job, started, 'rejected' if isinstance(e, AdmissionRejected) else 'error')
+                    await ready.put((job, None, e))
+                    return
+                self.__observe(job, started, 'ok')
+            await ready.put((job, data, None))
+
+        # Stickers are converted concurrently and emitted in completion order;
+        # each one's header and chunks are kept together on the stream.
+        tasks = [asyncio.ensure_future(convert(sticker)) for sticker in sticker_set.stickers]
+        try:
+            for _ in tasks:
+                job, data, error = await ready.get()
+                if error is None:
+                    # Built in full before anything is sent, so a failure cannot leave half a sticker on the stream.
+                    try:
+                        items = [StickerSetItem(header=StickerInSetHeader(
+                            input_file_id=job.file_id,
+                            content_type=CONTENT_TYPES[job.out_format],
+                            actual_format=OUTPUT_FORMAT_PROTO_MAP[job.out_format],
+                        ))]
+                        items += [StickerSetItem(data_chunk=chunk) for piece in data for chunk in split_chunks(piece)]
+                    except Exception as e:
+                        error = e
+                if error is not None:
+                    print(f"Error processing sticker {job.file_id} of set {request.sticker_set_name}: {error}")
+                    yield StickerSetItem(error=StickerProcessingError(
+                        input_file_id=job.file_id,
+                        error_message=str(error),
+                    ))
+                    continue
+
+                for item in items:
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __get_file_info(self, file_id: str):
+        try:
+            file_info = await self.__downloader.get_file_info(file_id)
+        except Exception as e:
+            print(f"Error getting file info from Telegram: {e}")
+            raise GetFileError(f"Error getting file info: {e}")
 
         if not file_info.file_path:
             print("File path not found in file_info")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details("File path not available from Telegram.")
-            raise GetFileError
+            raise GetFileError("File path not available from Telegram.")
 
         return file_info
 
-    async def __run_process_and_stream(self, processor: StickerProcessor, file_bytes: bytes,
-                                       in_format: str, out_format: str,
-                                       width: int, height: int,
-                                       sticker_file_id: str):
-        result = await processor.process(file_bytes, in_format, out_format, width, height)
+    @staticmethod
+    def __deadline(context: grpc.aio.ServicerContext) -> Optional[float]:
+        """The RPC deadline on the ``time.monotonic()`` clock, if the client set one."""
+        remaining = context.time_remaining()
+        return None if remaining is None else time.monotonic() + remaining
+
+    @staticmethod
+    def __processor(job: ConversionJob) -> StickerProcessor:
+        return (
+            asp if job.is_animated else
+            vsp if job.is_video else
+            ssp
+        )
 
-        chunk_size = 2 ** 18
-        chunks_count = (len(result) + chunk_size - 1) // chunk_size
+    def __observe(self, job: ConversionJob, started: float, status: str):
+        processor = self.__processor(job).name
+        REQUESTS.inc(processor=processor, format=job.out_format, status=status)
+        if status == 'ok':
+            REQUEST_DURATION.observe(time.perf_counter() - started, processor=processor, format=job.out_format)
+
+    async def __convert(self, job: ConversionJob, deadline: Optional[float]) -> AsyncIterator[bytes]:
+        processor = self.__processor(job)
+        with stage('get_file', processor.name, job.out_format):
+            file_info = await self.__get_file_info(job.file_id)
+
+        cache_key = None
+        if file_info.file_unique_id:
+            cache_key = make_cache_key(file_info.file_unique_id, job.out_format, job.width, job.height,
+                                       job.options.cache_variant())
+            cached = await self.__results.aget(cache_key)
+            if cached is not None:
+                yield cached
+                return
 
-        content_type = CONTENT_TYPES[out_format]
-        proto_format = OUTPUT_FORMAT_PROTO_MAP[out_format]
+        try:
+            with stage('download', processor.name, job.out_format):
+                file_bytes = await self.__downloader.download(file_info)
+        except Exception as e:
+            raise FileDownloadError(f"Error downloading file: {e}")
+
+        if cache_key is None:
+            cache_key = make_cache_key(content_hash(file_bytes), job.out_format, job.width, job.height,
+                                       job.options.cache_variant())
+            cached = await self.__results.aget(cache_key)
+            if cached is not None:
+                yield cached
+                return
+
+        in_format = infer_sticker_type(job, file_bytes)
+        # Output too large for any cache tier is not collected a second time.
+        result = []
+        size = 0
+        # A shared conversion is admitted against the deadline of the caller that started it.
+        async with processor.limiter.slot(deadline, job.out_format):
+            async for chunk in processor.stream(file_bytes, in_format, job.out_format, job.width, job.height,
+                                                job.options):
+                size += len(chunk)
+                if result is not None and size > self.__results.max_entry_bytes:
+                    result = None
+                if result is not None:
+                    result.append(chunk)
+                yield chunk
+        if result is not None:
+            await self.__fill_cache(cache_key, result)
 
-        meta = StickerFileMetadata(
-            input_file_id=sticker_file_id,
-            content_type=content_type,
-            actual_format=proto_format
-        )
-        yield StickerFileChunk(metadata=meta)
+    async def __fill_cache(self, cache_key: str, result: list):
+        """Store a finished result. Callers have already received it, so a failed write is only logged."""
+        try:
+            await self.__results.aput(cache_key, b''.join(result))
+        except Exception as e:
+            print(f"Error caching conversion result {cache_key}: {e}")
 
-        for i in range(chunks_count):
-            start = i * chunk_size
-            end = start + chunk_size
-            chunk = result[start:end]
-            yield StickerFileChunk(data_chunk=chunk)
+    def __stream_job(self, job: ConversionJob, deadline: Optional[float] = None) -> AsyncIterator[bytes]:
+        return self.__conversions.stream(job, lambda: self.__convert(job, deadline))
 
+    async def ConvertBytes(self, request_iterator, context: grpc.aio.ServicerContext):
+        """Convert a file uploaded by the caller instead of one fetched from Telegram."""
+        with IN_FLIGHT.track(method='ConvertBytes'):
+            async for chunk in self.__convert_bytes(request_iterator, context):
+                yield chunk
 
-    def __build_grpc_chunks(self, result: bytes, sticker_file_id: str):
-        chunk_size = 2 ** 18
-        chunks_count = (len(result) + chunk_size - 1) // chunk_size
+    async def __convert_bytes(self, request_iterator, context: grpc.aio.ServicerContext):
+        requests = request_iterator.__aiter__()
+        head = []
+        uploaded = False
+        try:
+            try:
+                first = await requests.__anext__()
+            except StopAsyncIteration:
+                raise ValueError('No input was sent')
+            if first.WhichOneof('payload') != 'metadata':
+                raise ValueError('The first message must carry the metadata')
+            try:
+                out_format = output_format_to_str(first.metadata.actual_format)
+            except KeyError:
+                raise ValueError(f'Unsupported output format: {first.metadata.actual_format}')
+            width, height = parse_size(context.invocation_metadata())
+            options = parse_conversion_options(context.invocation_metadata())
+
+            while sum(map(len, head)) < SNIFF_BYTES:
+                try:
+                    head.append((await requests.__anext__()).data_chunk)
+                except StopAsyncIteration:
+                    uploaded = True
+                    break
+            in_format = infer_input_format(first.metadata.content_type, b''.join(head))
+            if in_format != 'webm' and not uploaded:
+                # Lottie JSON and still images can only be decoded once complete.
+                size = sum(map(len, head))
+                async for message in requests:
+                    size += len(message.data_chunk)
+                    check_upload_size(size)
+                    head.append(message.data_chunk)
+                uploaded = True
+            check_upload_size(sum(map(len, head)))
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return
 
+        if in_format == 'tgs':
+            width, height = width or DEFAULT_ANIMATED_SIZE, height or DEFAULT_ANIMATED_SIZE
+        job = ConversionJob(
+            file_id=first.metadata.input_file_id,
+            is_animated=in_format == 'tgs',
+            is_video=in_format == 'webm',
+            out_format=out_format,
+            width=width,
+            height=height,
+            options=options,
+        )
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            async for chunk in self.__send(job, self.__convert_upload(
+                    job, in_format, head, None if uploaded else requests, self.__deadline(context))):
+                yield chunk
+            status = 'ok'
+        except (asyncio.CancelledError, GeneratorExit):
+            status = 'cancelled'
+            raise
+        except AdmissionRejected as e:
+            status = 'rejected'
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details(str(e))
+        except UploadTooLarge as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+        except Exception as e:
+            print(f"Processing error: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(f"Processing error: {str(e)}")
+        finally:
+            self.__observe(job, started, status)
+
+    async def __convert_upload(self, job: ConversionJob, in_format: str, head: list, requests,
+                               deadline: Optional[float]) -> AsyncIterator[bytes]:
+        """Convert uploaded data; ``requests`` holds the rest of the upload, if any is still to come."""
+        processor = self.__processor(job)
+        variant = job.options.cache_variant()
+        if requests is None:
+            data = b''.join(head)
+            cache_key = make_cache_key(content_hash(data), job.out_format, job.width, job.height, variant)
+            cached = await self.__results.aget(cache_key)
+            if cached is not None:
+                yield cached
+                return
+            pieces = processor.stream(data, in_format, job.out_format, job.width, job.height, job.options)
+        else:
+            # WebM goes straight into ffmpeg while the rest is still uploading.
+            feed = InputFeed()
+            hasher = hashlib.sha256()
+            for piece in head:
+                feed.push(piece)
+                hasher.update(piece)
+
+            async def upload():
+                size = sum(map(len, head))
+                try:
+                    async for message in requests:
+                        size += len(message.data_chunk)
+                        check_upload_size(size)
+                        feed.push(message.data_chunk)
+                        hasher.update(message.data_chunk)
+                except Exception as e:
+                    feed.finish(e)
+                    raise
+                except BaseException:
+                    feed.finish(ConnectionAbortedError('upload was cancelled'))
+                    raise
+                feed.finish()
+
+            pieces = None
+            cache_key = None
+
+        result = []
+        size = 0
+        upload_task = None
+        try:
+            async with processor.limiter.slot(deadline, job.out_format):
+                if pieces is None:
+                    # Only read the rest of the upload once admitted; until then
+                    # flow control holds the client back instead of the feed buffering it.
+                    upload_task = asyncio.ensure_future(upload())
+                    pieces = self.__finish_upload(
+                        processor.stream_input(feed, in_format, job.out_format, job.width, job.height,
+                                               job.options),
+                        upload_task)
+                async for chunk in pieces:
+                    size += len(chunk)
+                    if result is not None and size > self.__results.max_entry_bytes:
+                        result = None
+                    if result is not None:
+                        result.append(chunk)
+                    yield chunk
+        finally:
+            if upload_task is not None:
+                upload_task.cancel()
+        if result is not None:
+            if cache_key is None:
+                cache_key = make_cache_key(hasher.hexdigest(), job.out_format, job.width, job.height, variant)
+            await self.__fill_cache(cache_key, result)
+
+    @staticmethod
+    async def __finish_upload(pieces: AsyncIterator[bytes], upload_task: asyncio.Future) -> AsyncIterator[bytes]:
+        """Yield ``pieces``; make sure the upload completed, and stop it if the conversion ends first."""
+        try:
+            async for piece in pieces:
+                yield piece
+            await upload_task
+        except Exception:
+            # A conversion cut short by a failed upload reports why the upload failed.
+            if upload_task.done() and not upload_task.cancelled() and upload_task.exception() is not None:
+                raise upload_task.exception()
+            raise
+        finally:
+            upload_task.cancel()
+
+    async def __send(self, job: ConversionJob, pieces: AsyncIterator[bytes]):
+        # The metadata goes out with the first piece of output, so failures that
+        # happen before anything was produced surface as a clean error status.
+        # The "stream" stage is the time spent handing chunks to gRPC, i.e.
+        # waiting on flow control and the client.
+        metadata_sent = False
+        sending = 0.0
+        async for data in pieces:
+            started = time.perf_counter()
+            if not metadata_sent:
+                yield self.__build_metadata_chunk(job)
+                metadata_sent = True
+            for chunk in split_chunks(data):
+                yield StickerFileChunk(data_chunk=chunk)
+            sending += time.perf_counter() - started
+        if not metadata_sent:
+            yield self.__build_metadata_chunk(job)
+        STAGE_DURATION.observe(sending, stage='stream', processor=self.__processor(job).name, format=job.out_format)
+
+    def __build_metadata_chunk(self, job: ConversionJob) -> StickerFileChunk:
         meta = StickerFileMetadata(
-            input_file_id=sticker_file_id,
-            content_type="image/png",
-            actual_format=OutputFormat.OUTPUT_FORMAT_WEBM
+            input_file_id=job.file_id,
+            content_type=CONTENT_TYPES[job.out_format],
+            actual_format=OUTPUT_FORMAT_PROTO_MAP[job.out_format]
         )
-        yield StickerFileChunk(metadata=meta)
-
-        for i in range(chunks_count):
-            start = i * chunk_size
-            end = start + chunk_size
-            chunk = result[start:end]
-            yield StickerFileChunk(data_chunk=chunk)
+        return StickerFileChunk(metadata=meta)
+
+
+def add_to_server(servicer: TelegramStickersConverterServicer, server):
+    """Register the generated service plus the ConvertBytes method."""
+    telegram_stickers_converter_pb2_grpc.add_StickerConverterServiceServicer_to_server(servicer, server)
+    server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(SERVICE_NAME, {
+        'ConvertBytes': grpc.stream_stream_rpc_method_handler(
+            servicer.ConvertBytes,
+            request_deserializer=StickerFileChunk.FromString,
+            response_serializer=StickerFileChunk.SerializeToString,
+        ),
+    }),))
@@ -0,0 +1,93 @@
+import asyncio
+from typing import AsyncIterator, Callable, Dict, Generic, Hashable, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Broadcast(Generic[T]):
+    """Pumps an async stream once and replays it to any number of subscribers.
+
+    Produced items are retained, so a subscriber that joins late still sees the
+    stream from the start. The pump runs as its own task, so one subscriber
+    going away does not affect the others; once the last one has left before
+    the stream finished, the pump is cancelled and the flight is ``abandoned``.
+    """
+
+    def __init__(self, source: AsyncIterator[T]):
+        self.items: List[T] = []
+        self.finished = False
+        self.abandoned = False
+        self.error: Optional[BaseException] = None
+        self.__subscribers = 0
+        self.__wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.__pump(source))
+
+    async def __pump(self, source: AsyncIterator[T]):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self.__notify()
+        except asyncio.CancelledError:
+            self.error = ConnectionAbortedError("conversion was cancelled")
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self.__notify()
+
+    def __notify(self):
+        wakeup, self.__wakeup = self.__wakeup, asyncio.Event()
+        wakeup.set()
+
+    def subscribe(self) -> AsyncIterator[T]:
+        # Counted right away rather than on first iteration, so a subscriber
+        # that has not started reading yet keeps the flight alive.
+        self.__subscribers += 1
+        return self.__follow()
+
+    async def __follow(self) -> AsyncIterator[T]:
+        position = 0
+        try:
+            while True:
+                while position < len(self.items):
+                    yield self.items[position]
+                    position += 1
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self.__wakeup.wait()
+        finally:
+            self.__subscribers -= 1
+            if not self.__subscribers and not self.finished:
+                self.abandoned = True
+                self.task.cancel()
+
+
+class SingleFlight:
+    """Coalesces concurrent streams sharing a key into one in-flight execution.
+
+    The first caller starts the producer; callers arriving while it is still
+    running subscribe to the same :class:`Broadcast` and receive every item it
+    has produced so far followed by the rest as it arrives. When every caller
+    has gone away the producer is cancelled, and the next caller starts afresh.
+    """
+
+    def __init__(self):
+        self.__flights: Dict[Hashable, Broadcast] = {}
+
+    def stream(self, key: Hashable, factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        flight = self.__flights.get(key)
+        if flight is None or flight.abandoned:
+            flight = Broadcast(factory())
+            self.__flights[key] = flight
+            flight.task.add_done_callback(lambda _: self.__forget(key, flight))
+        return flight.subscribe()
+
+    def __forget(self, key: Hashable, flight: Broadcast):
+        if self.__flights.get(key) is flight:
+            del self.__flights[key]
+
+    def in_flight(self) -> int:
+        return len(self.__flights)
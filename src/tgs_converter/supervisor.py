@@ -0,0 +1,125 @@
+"""Pre-spawned multi-process server mode.
+
+A single grpc.aio process is bound to one core for everything that holds the
+GIL. The :class:`Supervisor` runs several complete server processes instead;
+they all bind the same port with ``SO_REUSEPORT`` and the kernel spreads
+incoming connections across them. Workers that die are restarted, and on
+SIGTERM or SIGINT every worker is asked to drain before the supervisor exits.
+"""
+import contextlib
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Optional
+
+
+def _run_worker(target: Callable[[int], None], index: int):
+    # A group of its own, so whatever the worker started can be killed along with it.
+    os.setpgid(0, 0)
+    target(index)
+
+
+def _kill_group(pid: int):
+    """Kill what is left of a worker's process group: engine pool processes, ffmpeg children."""
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        os.killpg(pid, signal.SIGKILL)
+
+
+class Supervisor:
+    """Keeps ``workers`` copies of ``target(index)`` running.
+
+    Workers are spawned rather than forked: the supervisor has already imported
+    grpc, and forking a process that has grpc loaded is unsafe. Each worker
+    leads its own process group, which is killed once the worker has exited.
+    """
+
+    MIN_RESTART_DELAY = 0.5
+    MAX_RESTART_DELAY = 30.0
+    STABLE_AFTER = 10.0
+
+    def __init__(self, workers: int, target: Callable[[int], None], drain_timeout: float):
+        self.workers = workers
+        self.target = target
+        self.drain_timeout = drain_timeout
+        self.__context = multiprocessing.get_context("spawn")
+        self.__processes: Dict[int, multiprocessing.Process] = {}
+        self.__started: Dict[int, float] = {}
+        self.__restart_delay: Dict[int, float] = {}
+        self.__restart_at: Dict[int, float] = {}
+        self.__stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.__request_stop)
+        signal.signal(signal.SIGINT, self.__request_stop)
+        print(f"Supervisor starting {self.workers} workers...")
+        for index in range(self.workers):
+            self.__start(index)
+        try:
+            while not self.__stopping:
+                self.__reap(timeout=self.__next_wakeup())
+                self.__restart_due()
+        finally:
+            self.__drain()
+
+    def __request_stop(self, signum, _frame):
+        if not self.__stopping:
+            print(f"Supervisor received {signal.Signals(signum).name}, draining workers...")
+        self.__stopping = True
+
+    def __start(self, index: int):
+        process = self.__context.Process(target=_run_worker, args=(self.target, index), name=f"tgs-worker-{index}")
+        process.start()
+        self.__processes[index] = process
+        self.__started[index] = time.monotonic()
+        print(f"Worker {index} started with pid {process.pid}.")
+
+    def __next_wakeup(self) -> float:
+        if not self.__restart_at:
+            return 1.0
+        return max(0.0, min(self.__restart_at.values()) - time.monotonic())
+
+    def __reap(self, timeout: Optional[float]):
+        sentinels = {process.sentinel: index for index, process in self.__processes.items()}
+        if not sentinels:
+            time.sleep(timeout or 0)
+            return
+        for sentinel in wait(list(sentinels), timeout):
+            index = sentinels[sentinel]
+            process = self.__processes.pop(index)
+            process.join()
+            _kill_group(process.pid)
+            if self.__stopping:
+                continue
+            # Back off when a worker keeps dying right after it starts.
+            uptime = time.monotonic() - self.__started[index]
+            delay = self.__restart_delay.get(index, self.MIN_RESTART_DELAY)
+            delay = self.MIN_RESTART_DELAY if uptime >= self.STABLE_AFTER else min(delay * 2, self.MAX_RESTART_DELAY)
+            self.__restart_delay[index] = delay
+            self.__restart_at[index] = time.monotonic() + delay
+            print(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                  f"restarting in {delay:.1f}s.")
+
+    def __restart_due(self):
+        now = time.monotonic()
+        for index, when in list(self.__restart_at.items()):
+            if when <= now and not self.__stopping:
+                del self.__restart_at[index]
+                self.__start(index)
+
+    def __drain(self):
+        for process in self.__processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.drain_timeout
+        for process in self.__processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+        for index, process in self.__processes.items():
+            if process.is_alive():
+                print(f"Worker {index} did not drain in time, killing it.")
+                process.kill()
+                process.join()
+        for process in self.__processes.values():
+            _kill_group(process.pid)
+        print("Supervisor stopped.")
@@ -0,0 +1,265 @@
+"""Pre-convert stickers into the server's result store.
+
+Sticker sets and single file ids are converted in bulk with the same
+processors the server uses, without going through gRPC, and written to the
+disk tier under the keys GetSticker and GetStickerSet look up. Entries that
+are already stored are skipped without downloading anything, so an
+interrupted run picks up where it stopped when started again.
+
+    tgs-converter-warm --cache-dir /var/cache/tgs --set HalloweenPack --format webp --format gif
+    tgs-converter-warm --cache-dir /var/cache/tgs -i trending.txt --format webm --size 256x256
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from os import environ
+from typing import List, NamedTuple, Optional, Tuple
+
+from tgs_converter.cache import DiskCache, MemoryLRUCache, ResultCache, make_cache_key
+from tgs_converter.options import ANIMATED_FORMATS, ConversionOptions, SEQUENCE_FORMATS, STATIC_FORMATS
+
+
+class WarmTarget(NamedTuple):
+    file_id: str
+    file_unique_id: str
+    # None when the sticker type is only known once the file is downloaded.
+    is_animated: Optional[bool]
+    is_video: Optional[bool]
+    native_size: Tuple[int, int]
+
+
+class WarmStats:
+    def __init__(self):
+        self.converted = 0
+        self.skipped = 0
+        self.unsupported = 0
+        self.failed = 0
+
+
+def parse_size(value: str) -> Optional[Tuple[int, int]]:
+    """``WxH``, or ``native`` for the size GetStickerSet converts to."""
+    if value == "native":
+        return None
+    try:
+        width, height = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT or 'native', got {value!r}")
+    if width < 0 or height < 0:
+        raise argparse.ArgumentTypeError("sizes must not be negative")
+    return width, height
+
+
+def read_inputs(path: str) -> Tuple[List[str], List[str]]:
+    """Read ``set:<name>`` and ``file:<file id>`` lines; blank lines and ``#`` comments are ignored."""
+    sets, files = [], []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            kind, _, value = line.partition(":")
+            if kind == "set" and value:
+                sets.append(value.strip())
+            elif kind == "file" and value:
+                files.append(value.strip())
+            else:
+                raise ValueError(f"{path}:{number}: expected 'set:<name>' or 'file:<file id>'")
+    return sets, files
+
+
+class Warmer:
+    def __init__(self, downloader, store: ResultCache, formats: List[str], sizes: List[Optional[Tuple[int, int]]],
+                 options: ConversionOptions, jobs: int):
+        self.downloader = downloader
+        self.store = store
+        self.formats = formats
+        self.sizes = sizes
+        self.options = options
+        self.stats = WarmStats()
+        self.__semaphore = asyncio.Semaphore(jobs)
+
+    async def run(self, sets: List[str], files: List[str]):
+        tasks = [asyncio.ensure_future(self.__warm_set(name)) for name in sets]
+        tasks += [asyncio.ensure_future(self.__warm_file(file_id)) for file_id in files]
+        await asyncio.gather(*tasks)
+
+    async def __warm_set(self, name: str):
+        try:
+            sticker_set = await self.downloader.bot.get_sticker_set(name=name)
+        except Exception as e:
+            print(f"Error getting sticker set {name}: {e}")
+            self.stats.failed += 1
+            return
+        print(f"Sticker set {name}: {len(sticker_set.stickers)} stickers.")
+        await asyncio.gather(*(self.__warm(WarmTarget(
+            file_id=sticker.file_id,
+            file_unique_id=sticker.file_unique_id,
+            is_animated=sticker.is_animated,
+            is_video=sticker.is_video,
+            native_size=(sticker.width, sticker.height),
+        )) for sticker in sticker_set.stickers))
+
+    async def __warm_file(self, file_id: str):
+        from tgs_converter.server import DEFAULT_ANIMATED_SIZE
+
+        async with self.__semaphore:
+            try:
+                file_info = await self.downloader.get_file_info(file_id)
+            except Exception as e:
+                print(f"Error getting file info for {file_id}: {e}")
+                self.stats.failed += 1
+                return
+        await self.__warm(WarmTarget(
+            file_id=file_id,
+            file_unique_id=file_info.file_unique_id,
+            is_animated=None,
+            is_video=None,
+            native_size=(DEFAULT_ANIMATED_SIZE, DEFAULT_ANIMATED_SIZE),
+        ), file_info)
+
+    def __missing(self, target: WarmTarget) -> List[Tuple[str, int, int, str]]:
+        missing = []
+        for out_format in self.formats:
+            for size in self.sizes:
+                width, height = size or target.native_size
+                key = make_cache_key(target.file_unique_id, out_format, width, height, self.options.cache_variant())
+                if key in self.store:
+                    self.stats.skipped += 1
+                else:
+                    missing.append((out_format, width, height, key))
+        return missing
+
+    def __supported(self, target: WarmTarget, processor,
+                    missing: List[Tuple[str, int, int, str]]) -> List[Tuple[str, int, int, str]]:
+        """The entries of ``missing`` ``processor`` can convert to; neither could the server do the rest."""
+        supported = []
+        for entry in missing:
+            if processor.supports(entry[0]):
+                supported.append(entry)
+            else:
+                print(f"Skipping {target.file_id} as {entry[0]}: not supported for {processor.name} stickers")
+                self.stats.unsupported += 1
+        return supported
+
+    async def __warm(self, target: WarmTarget, file_info=None):
+        from tgs_converter.server import asp, infer_input_format, infer_sticker_type, ssp, vsp
+
+        missing = self.__missing(target)
+        if missing and target.is_animated is not None:
+            # Stickers from sets have a known type, so formats it cannot be converted to cost no download.
+            missing = self.__supported(target, asp if target.is_animated else vsp if target.is_video else ssp,
+                                       missing)
+        if not missing:
+            return
+        async with self.__semaphore:
+            try:
+                if file_info is None:
+                    file_info = await self.downloader.get_file_info(target.file_id)
+                data = await self.downloader.download(file_info)
+                if target.is_animated is None:
+                    in_format = infer_input_format("", bytes(data[:16]))
+                else:
+                    in_format = infer_sticker_type(target, data)
+            except Exception as e:
+                print(f"Error downloading {target.file_id}: {e}")
+                self.stats.failed += 1
+                return
+            processor = asp if in_format == "tgs" else vsp if in_format == "webm" else ssp
+            if target.is_animated is None:
+                missing = self.__supported(target, processor, missing)
+            for out_format, width, height, key in missing:
+                started = time.perf_counter()
+                try:
+                    result = await processor.process(data, in_format, out_format, width, height, self.options)
+                except ValueError as e:
+                    # This sticker type cannot be converted to the format; neither could the server.
+                    print(f"Skipping {target.file_id} as {out_format}: {e}")
+                    self.stats.unsupported += 1
+                    continue
+                except Exception as e:
+                    print(f"Error converting {target.file_id} to {out_format} {width}x{height}: {e}")
+                    self.stats.failed += 1
+                    continue
+                try:
+                    await self.store.aput(key, result)
+                except Exception as e:
+                    print(f"Error storing {target.file_id} as {out_format} {width}x{height}: {e}")
+                    self.stats.failed += 1
+                    continue
+                self.stats.converted += 1
+                print(f"Converted {target.file_id} to {out_format} {width}x{height} "
+                      f"({len(result)} bytes, {time.perf_counter() - started:.2f}s).")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="tgs-converter-warm", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--set", dest="sets", action="append", default=[], metavar="NAME",
+                        help="sticker set to convert; may be repeated")
+    parser.add_argument("--file", dest="files", action="append", default=[], metavar="FILE_ID",
+                        help="single sticker file id to convert; may be repeated")
+    parser.add_argument("-i", "--input", metavar="PATH", help="file with one 'set:<name>' or 'file:<file id>' per line")
+    parser.add_argument("--format", dest="formats", action="append", required=True,
+                        # The formats GetSticker can ask for; nothing would read the others back.
+                        choices=ANIMATED_FORMATS + STATIC_FORMATS + SEQUENCE_FORMATS,
+                        help="output format; may be repeated")
+    parser.add_argument("--size", dest="sizes", action="append", type=parse_size, metavar="WxH",
+                        help="output size; 'native' (the default) is the sticker's own size as used by "
+                             "GetStickerSet, or 512x512 for file ids; may be repeated")
+    parser.add_argument("--option", dest="options", action="append", default=[], metavar="KEY=VALUE",
+                        help="conversion option as sent in request metadata, e.g. x-target-fps=30")
+    parser.add_argument("--cache-dir", default=environ.get("RESULT_CACHE_DIR"),
+                        help="the server's RESULT_CACHE_DIR (default: taken from the environment)")
+    parser.add_argument("-j", "--jobs", type=int, default=(os.cpu_count() or 1) * 4,
+                        help="stickers downloaded and converted concurrently")
+    return parser
+
+
+async def warm(args: argparse.Namespace) -> WarmStats:
+    from tgs_converter.bot import get_downloader
+    from tgs_converter.engine import engine
+    from tgs_converter.server import parse_conversion_options
+
+    options = parse_conversion_options([tuple(option.split("=", 1)) for option in args.options])
+    sets, files = list(args.sets), list(args.files)
+    if args.input:
+        more_sets, more_files = read_inputs(args.input)
+        sets += more_sets
+        files += more_files
+
+    # Only the disk tier outlives this process, so nothing is kept in memory.
+    store = ResultCache(MemoryLRUCache(0), DiskCache(
+        args.cache_dir, int(environ.get("RESULT_CACHE_DISK_BYTES", str(2 ** 30)))))
+    warmer = Warmer(get_downloader(), store, args.formats, args.sizes or [None], options, max(1, args.jobs))
+    try:
+        await warmer.run(sets, files)
+    finally:
+        engine.shutdown()
+    return warmer.stats
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    if not args.cache_dir:
+        parser.error("--cache-dir or RESULT_CACHE_DIR is required; only the disk tier is shared with the server")
+    if not (args.sets or args.files or args.input):
+        parser.error("nothing to convert; pass --set, --file or --input")
+    bad = [option for option in args.options if "=" not in option]
+    if bad:
+        parser.error(f"options must look like KEY=VALUE: {', '.join(bad)}")
+
+    started = time.perf_counter()
+    try:
+        stats = asyncio.run(warm(args))
+    except (ValueError, RuntimeError) as e:
+        parser.error(str(e))
+    print(f"Done in {time.perf_counter() - started:.1f}s: {stats.converted} converted, {stats.skipped} already "
+          f"stored, {stats.unsupported} unsupported, {stats.failed} failed.")
+    sys.exit(1 if stats.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
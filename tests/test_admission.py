@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+import pytest
+
+from tgs_converter.admission import AdmissionRejected, ConcurrencyLimiter
+
+
+async def hold(limiter: ConcurrencyLimiter, seconds: float, out_format: str = "webm"):
+    async with limiter.slot(None, out_format):
+        await asyncio.sleep(seconds)
+
+
+def test_idle_limiter_admits_regardless_of_slow_formats():
+    async def main():
+        limiter = ConcurrencyLimiter("animated", limit=1, max_queue=1)
+        await hold(limiter, 0.2)
+        # A free slot is taken even though webm conversions took longer than this deadline allows.
+        async with limiter.slot(time.monotonic() + 0.05, "png"):
+            active = limiter.active
+        return limiter, active
+
+    limiter, active = asyncio.run(main())
+    assert active == 1
+    assert limiter.active == 0
+    assert limiter.format_service_time("webm") >= 0.2
+    assert limiter.format_service_time("png") < 0.2
+
+
+def test_queued_request_gets_the_slot_once_it_is_released():
+    async def main():
+        limiter = ConcurrencyLimiter("animated", limit=1, max_queue=1)
+        running = asyncio.ensure_future(hold(limiter, 0.05))
+        await asyncio.sleep(0)
+        order = []
+
+        async def queued():
+            async with limiter.slot(time.monotonic() + 5, "png"):
+                order.append(("queued", running.done()))
+
+        waiting = asyncio.ensure_future(queued())
+        await asyncio.sleep(0)
+        assert limiter.waiting == 1
+        await asyncio.gather(running, waiting)
+        return limiter, order
+
+    limiter, order = asyncio.run(main())
+    assert order == [("queued", True)]
+    assert limiter.active == 0
+    assert limiter.waiting == 0
+
+
+def test_full_queue_is_rejected():
+    async def main():
+        limiter = ConcurrencyLimiter("animated", limit=1, max_queue=1)
+        running = asyncio.ensure_future(hold(limiter, 0.05))
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(hold(limiter, 0))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await hold(limiter, 0)
+        await asyncio.gather(running, queued)
+
+    asyncio.run(main())
+
+
+def test_deadline_expiring_in_the_queue_is_rejected():
+    async def main():
+        limiter = ConcurrencyLimiter("animated", limit=1, max_queue=1)
+        running = asyncio.ensure_future(hold(limiter, 0.3))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected, match="while waiting"):
+            async with limiter.slot(time.monotonic() + 0.05, "png"):
+                pass
+        waiting = limiter.waiting
+        await running
+        return limiter, waiting
+
+    limiter, waiting = asyncio.run(main())
+    assert waiting == 0
+    assert limiter.active == 0
+
+
+def test_deadline_before_the_estimated_completion_is_rejected_without_waiting():
+    async def main():
+        limiter = ConcurrencyLimiter("animated", limit=1, max_queue=1)
+        await hold(limiter, 0.2)
+        running = asyncio.ensure_future(hold(limiter, 0.2))
+        await asyncio.sleep(0)
+        started = time.monotonic()
+        with pytest.raises(AdmissionRejected, match="would be exceeded"):
+            async with limiter.slot(started + 0.3, "webm"):
+                pass
+        rejected_after = time.monotonic() - started
+        await running
+        return rejected_after
+
+    assert asyncio.run(main()) < 0.05
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from corpus import CorpusItem
+from fake_bot import FakeBot
+from tgs_converter.bot import TelegramDownloader
+
+
+class FlakyBot(FakeBot):
+    """Fails the first ``failures`` downloads, counting the ``get_file`` calls."""
+
+    def __init__(self, data: bytes, failures: int):
+        super().__init__({"sticker": CorpusItem("sticker", "static", data)})
+        self.failures = failures
+        self.get_file_calls = 0
+
+    async def get_file(self, file_id: str, **kwargs):
+        self.get_file_calls += 1
+        file_info = await super().get_file(file_id, **kwargs)
+        download = file_info.download_as_bytearray
+
+        async def flaky_download(buf=None) -> bytearray:
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("download failed")
+            return await download(buf)
+
+        file_info.download_as_bytearray = flaky_download
+        return file_info
+
+
+def downloader_for(bot: FakeBot) -> TelegramDownloader:
+    return TelegramDownloader(bot, file_info_ttl=60, file_info_entries=100, raw_cache_bytes=0)
+
+
+async def fetch(downloader: TelegramDownloader) -> bytes:
+    return await downloader.download(await downloader.get_file_info("sticker"))
+
+
+def test_freshly_resolved_link_is_not_retried():
+    bot = FlakyBot(b"data", failures=1)
+    with pytest.raises(ConnectionError):
+        asyncio.run(fetch(downloader_for(bot)))
+    assert bot.get_file_calls == 1
+
+
+def test_recently_cached_link_is_not_retried():
+    async def main():
+        downloader = downloader_for(bot)
+        await downloader.get_file_info("sticker")
+        return await fetch(downloader)
+
+    bot = FlakyBot(b"data", failures=1)
+    with pytest.raises(ConnectionError):
+        asyncio.run(main())
+    assert bot.get_file_calls == 1
+
+
+def test_old_cached_link_is_resolved_again_once(monkeypatch):
+    async def main():
+        downloader = downloader_for(bot)
+        await downloader.get_file_info("sticker")
+        return await fetch(downloader)
+
+    monkeypatch.setattr(TelegramDownloader, "FRESH_LINK_AGE", 0.0)
+    bot = FlakyBot(b"data", failures=1)
+    assert asyncio.run(main()) == b"data"
+    assert bot.get_file_calls == 2
+
+    bot = FlakyBot(b"data", failures=2)
+    with pytest.raises(ConnectionError):
+        asyncio.run(main())
+    assert bot.get_file_calls == 2
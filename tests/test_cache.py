@@ -0,0 +1,95 @@
+import asyncio
+import os
+import subprocess
+import time
+
+from tgs_converter import cache
+from tgs_converter.cache import DiskCache, MemoryLRUCache, ResultCache, make_cache_key
+
+
+def test_cache_key_includes_the_variant_only_when_set():
+    assert make_cache_key("abc", "webm", 512, 512) == "abc:webm:512x512"
+    assert make_cache_key("abc", "webm", 512, 512, "target_fps=30.0") == "abc:webm:512x512:target_fps=30.0"
+
+
+def test_memory_cache_evicts_least_recently_used_by_size():
+    memory = MemoryLRUCache(10)
+    memory.put("a", b"1234")
+    memory.put("b", b"1234")
+    assert memory.get("a") == b"1234"
+    memory.put("c", b"1234")
+    assert "b" not in memory
+    assert memory.get("a") == memory.get("c") == b"1234"
+    assert memory.size == 8
+    assert memory.stats.evictions == 1
+    memory.put("huge", b"x" * 11)
+    assert "huge" not in memory
+
+
+def test_disk_cache_entries_survive_a_restart(tmp_path):
+    DiskCache(str(tmp_path), 100).put("key", b"value")
+    disk = DiskCache(str(tmp_path), 100)
+    assert "key" in disk
+    assert disk.get("key") == b"value"
+    assert disk.size == 5
+
+
+def test_disk_cache_evicts_oldest_files_over_budget(tmp_path):
+    disk = DiskCache(str(tmp_path), 10)
+    disk.put("a", b"123456")
+    disk.put("b", b"123456")
+    assert "a" not in disk
+    assert disk.get("b") == b"123456"
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_disk_cache_picks_up_entries_another_process_wrote(tmp_path):
+    reader = DiskCache(str(tmp_path), 100)
+    DiskCache(str(tmp_path), 100).put("key", b"value")
+    assert reader.get("key") == b"value"
+    assert "key" in reader
+
+
+def test_disk_cache_start_up_removes_only_stale_temporary_files(tmp_path):
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    old = time.time() - DiskCache.DEAD_WRITER_GRACE - 1
+    files = {
+        "live": f"entry.{os.getpid()}.1.tmp",
+        "dead_young": f"entry.{dead.pid}.1.tmp",
+        "dead_old": f"other.{dead.pid}.1.tmp",
+        "abandoned": f"entry.{os.getpid()}.2.tmp",
+    }
+    for name in files.values():
+        (tmp_path / name).write_bytes(b"partial")
+    for kind in ("live", "dead_old"):
+        os.utime(tmp_path / files[kind], (old, old))
+    very_old = time.time() - DiskCache.STALE_TMP_AGE - 1
+    os.utime(tmp_path / files["abandoned"], (very_old, very_old))
+
+    disk = DiskCache(str(tmp_path), 100)
+    assert sorted(os.listdir(tmp_path)) == sorted([files["live"], files["dead_young"]])
+    assert len(disk) == 0
+
+
+def test_result_cache_promotes_disk_hits_to_memory(tmp_path):
+    disk = DiskCache(str(tmp_path), 100)
+    disk.put("key", b"value")
+    results = ResultCache(MemoryLRUCache(100), disk)
+    assert "key" not in results.memory
+    assert asyncio.run(results.aget("key")) == b"value"
+    assert "key" in results.memory
+    asyncio.run(results.aput("other", b"data"))
+    assert results.get("other") == b"data"
+    assert disk.get("other") == b"data"
+    assert results.max_entry_bytes == 100
+
+
+def test_result_cache_is_built_on_first_use(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "_result_cache", None)
+    monkeypatch.setenv("RESULT_CACHE_DIR", str(tmp_path / "results"))
+    assert not (tmp_path / "results").exists()
+    results = cache.get_result_cache()
+    assert results is cache.get_result_cache()
+    assert results.disk is not None
+    assert (tmp_path / "results").is_dir()
@@ -0,0 +1,166 @@
+"""End-to-end checks of the servicer over a loopback gRPC channel, with a fake Bot API."""
+import asyncio
+import io
+from typing import Dict
+
+import grpc
+import pytest
+from PIL import Image
+
+from corpus import CorpusItem
+from fake_bot import FakeBot
+from generated.telegram_stickers_converter.telegram_stickers_converter_pb2 import GetStickerRequest, \
+    GetStickerSetRequest, StickerFileChunk, StickerFileMetadata
+from generated.telegram_stickers_converter.telegram_stickers_converter_pb2_grpc import StickerConverterServiceStub
+from tgs_converter.bot import TelegramDownloader
+from tgs_converter.options import ConversionOptions
+from tgs_converter import server
+from tgs_converter.server import OUTPUT_FORMAT_PROTO_MAP, SERVICE_NAME, TelegramStickersConverterServicer, \
+    add_to_server, parse_conversion_options
+
+
+def image_bytes(image_format: str, size: int = 64) -> bytes:
+    output = io.BytesIO()
+    Image.new("RGBA", (size, size), (255, 128, 0, 200)).save(output, format=image_format)
+    return output.getvalue()
+
+
+def static_corpus(files: Dict[str, bytes]) -> Dict[str, CorpusItem]:
+    return {name: CorpusItem(name, "static", data) for name, data in files.items()}
+
+
+def run_with_channel(files: Dict[str, bytes], test):
+    """Run ``test`` against a servicer whose Bot API serves ``files`` as static stickers."""
+    async def main():
+        bot = FakeBot(static_corpus(files))
+        downloader = TelegramDownloader(bot, file_info_ttl=60, file_info_entries=100, raw_cache_bytes=0)
+        grpc_server = grpc.aio.server()
+        add_to_server(TelegramStickersConverterServicer(downloader=downloader), grpc_server)
+        port = grpc_server.add_insecure_port("127.0.0.1:0")
+        await grpc_server.start()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                return await test(channel)
+        finally:
+            await grpc_server.stop(None)
+
+    return asyncio.run(main())
+
+
+def run_with_stub(files: Dict[str, bytes], test):
+    return run_with_channel(files, lambda channel: test(StickerConverterServiceStub(channel)))
+
+
+async def convert_bytes(channel, content_type: str, out_format: str, data: bytes, piece_size: int = 1024):
+    """Upload ``data`` through ConvertBytes; the status code and the output."""
+    def messages():
+        yield StickerFileChunk(metadata=StickerFileMetadata(
+            input_file_id="upload", content_type=content_type, actual_format=OUTPUT_FORMAT_PROTO_MAP[out_format]))
+        for start in range(0, len(data), piece_size):
+            yield StickerFileChunk(data_chunk=data[start:start + piece_size])
+
+    call = channel.stream_stream(
+        f"/{SERVICE_NAME}/ConvertBytes",
+        request_serializer=StickerFileChunk.SerializeToString,
+        response_deserializer=StickerFileChunk.FromString,
+    )(messages())
+    output = b""
+    try:
+        async for chunk in call:
+            output += chunk.data_chunk
+    except grpc.aio.AioRpcError:
+        pass
+    return await call.code(), output
+
+
+def test_get_sticker_passes_matching_static_sticker_through():
+    webp = image_bytes("WEBP")
+
+    async def test(stub):
+        call = stub.GetSticker(GetStickerRequest(
+            sticker_file_id="sticker", desired_format=OUTPUT_FORMAT_PROTO_MAP["webp"], width=0, height=0))
+        data = b"".join([chunk.data_chunk async for chunk in call])
+        return await call.code(), data
+
+    code, data = run_with_stub({"sticker": webp}, test)
+    assert code == grpc.StatusCode.OK
+    assert data == webp
+
+
+def test_get_sticker_set_passes_matching_static_stickers_through():
+    # The fake Bot API reports every sticker as 512x512.
+    files = {"a": image_bytes("PNG", size=512), "b": image_bytes("PNG", size=512)}
+
+    async def test(stub):
+        call = stub.GetStickerSet(GetStickerSetRequest(
+            sticker_set_name="set", desired_format_for_all=OUTPUT_FORMAT_PROTO_MAP["png"]))
+        results, current = {}, None
+        async for item in call:
+            kind = item.WhichOneof("item")
+            assert kind != "error", item.error.error_message
+            if kind == "header":
+                current = item.header.input_file_id
+                results[current] = b""
+            else:
+                results[current] += item.data_chunk
+        return await call.code(), results
+
+    code, results = run_with_stub(files, test)
+    assert code == grpc.StatusCode.OK
+    # The fake Bot API names a set's stickers "<file>#<set name>".
+    assert results == {f"{name}#set": data for name, data in files.items()}
+
+
+def test_parse_conversion_options_reads_known_keys():
+    options = parse_conversion_options([("x-target-fps", "24"), ("x-quality", "80"), ("user-agent", "test")])
+    assert options == ConversionOptions(target_fps=24.0, quality=80)
+
+
+@pytest.mark.parametrize("key, value", [
+    ("x-target-fps", "nan"),
+    ("x-target-fps", "inf"),
+    ("x-target-fps", "1e-300"),
+    ("x-target-fps", "1000"),
+    ("x-target-fps", "-5"),
+    ("x-max-frames", "many"),
+    ("x-quality", "0"),
+    ("x-webp-method", "7"),
+])
+def test_parse_conversion_options_rejects_malformed_values(key, value):
+    with pytest.raises(ValueError):
+        parse_conversion_options([(key, value)])
+
+
+def test_get_sticker_rejects_non_finite_target_fps():
+    async def test(stub):
+        call = stub.GetSticker(GetStickerRequest(
+            sticker_file_id="sticker", desired_format=OUTPUT_FORMAT_PROTO_MAP["webp"], width=0, height=0),
+            metadata=[("x-target-fps", "nan")])
+        with pytest.raises(grpc.aio.AioRpcError):
+            async for _ in call:
+                pass
+        return await call.code()
+
+    assert run_with_stub({"sticker": image_bytes("WEBP")}, test) == grpc.StatusCode.INVALID_ARGUMENT
+
+
+def test_convert_bytes_converts_an_upload():
+    png = image_bytes("PNG")
+    code, output = run_with_channel({}, lambda channel: convert_bytes(channel, "image/png", "png", png))
+    assert code == grpc.StatusCode.OK
+    assert output == png
+
+
+def test_convert_bytes_rejects_a_content_type_the_data_does_not_match():
+    webp = image_bytes("WEBP")
+    code, output = run_with_channel({}, lambda channel: convert_bytes(channel, "application/x-tgsticker", "png", webp))
+    assert code == grpc.StatusCode.INVALID_ARGUMENT
+    assert output == b""
+
+
+def test_convert_bytes_rejects_an_upload_over_the_limit(monkeypatch):
+    png = image_bytes("PNG", size=256)
+    monkeypatch.setattr(server, "MAX_UPLOAD_BYTES", len(png) - 1)
+    code, output = run_with_channel({}, lambda channel: convert_bytes(channel, "image/png", "webp", png, piece_size=64))
+    assert code == grpc.StatusCode.INVALID_ARGUMENT
+    assert output == b""
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from tgs_converter.singleflight import SingleFlight
+
+
+class Conversion:
+    """A producer that yields ``chunks`` one at a time, each after ``release`` is set."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.runs = 0
+        self.produced = 0
+        self.release = asyncio.Event()
+
+    async def run(self):
+        self.runs += 1
+        for chunk in self.chunks:
+            await self.release.wait()
+            self.release.clear()
+            self.produced += 1
+            yield chunk
+
+
+async def collect(stream) -> bytes:
+    return b"".join([chunk async for chunk in stream])
+
+
+async def step(conversion: Conversion):
+    """Let the producer emit one chunk and every reader catch up with it."""
+    produced = conversion.produced
+    conversion.release.set()
+    while conversion.produced == produced:
+        await asyncio.sleep(0)
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_late_joiner_gets_the_whole_stream_from_one_conversion():
+    async def main():
+        flights = SingleFlight()
+        conversion = Conversion([b"a", b"b", b"c", b"d"])
+        first = asyncio.ensure_future(collect(flights.stream("key", conversion.run)))
+        await step(conversion)
+        await step(conversion)
+        # The first reader has consumed two chunks by now.
+        late = asyncio.ensure_future(collect(flights.stream("key", conversion.run)))
+        await step(conversion)
+        await step(conversion)
+        return conversion.runs, await first, await late, flights.in_flight()
+
+    runs, first, late, in_flight = asyncio.run(main())
+    assert runs == 1
+    assert first == late == b"abcd"
+    assert in_flight == 0
+
+
+def test_one_reader_leaving_does_not_stop_the_others():
+    async def main():
+        flights = SingleFlight()
+        conversion = Conversion([b"a", b"b", b"c"])
+        leaving = asyncio.ensure_future(collect(flights.stream("key", conversion.run)))
+        staying = asyncio.ensure_future(collect(flights.stream("key", conversion.run)))
+        await step(conversion)
+        leaving.cancel()
+        await step(conversion)
+        await step(conversion)
+        return conversion.runs, await staying
+
+    runs, staying = asyncio.run(main())
+    assert runs == 1
+    assert staying == b"abc"
+
+
+def test_flight_is_cancelled_once_every_reader_left_and_restarts():
+    async def main():
+        flights = SingleFlight()
+        conversion = Conversion([b"a", b"b"])
+        reader = asyncio.ensure_future(collect(flights.stream("key", conversion.run)))
+        await step(conversion)
+        reader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await reader
+        again = asyncio.ensure_future(collect(flights.stream("key", conversion.run)))
+        await step(conversion)
+        await step(conversion)
+        return conversion.runs, await again
+
+    runs, again = asyncio.run(main())
+    assert runs == 2
+    assert again == b"ab"
+
+
+def test_producer_error_reaches_every_reader():
+    async def failing():
+        yield b"a"
+        raise RuntimeError("encoder failed")
+
+    async def main():
+        flights = SingleFlight()
+        readers = [asyncio.ensure_future(collect(flights.stream("key", failing))) for _ in range(2)]
+        return await asyncio.gather(*readers, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
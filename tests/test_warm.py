@@ -0,0 +1,47 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+from corpus import CorpusItem
+from fake_bot import FakeBot
+from tgs_converter.bot import TelegramDownloader
+from tgs_converter.cache import DiskCache, MemoryLRUCache, ResultCache
+from tgs_converter.options import DEFAULT_OPTIONS
+from tgs_converter.warm import Warmer, build_parser
+
+
+def png_sticker(name: str) -> CorpusItem:
+    output = io.BytesIO()
+    # The fake Bot API reports every sticker as 512x512, so PNG output passes through.
+    Image.new("RGBA", (512, 512), (0, 128, 255, 255)).save(output, format="PNG")
+    return CorpusItem(name, "static", output.getvalue())
+
+
+def run_warmer(bot: FakeBot, directory: str, formats):
+    downloader = TelegramDownloader(bot, file_info_ttl=60, file_info_entries=100, raw_cache_bytes=0)
+    store = ResultCache(MemoryLRUCache(0), DiskCache(directory, 2 ** 20))
+    warmer = Warmer(downloader, store, formats, [None], DEFAULT_OPTIONS, jobs=2)
+    asyncio.run(warmer.run(["pack"], []))
+    return warmer.stats
+
+
+def test_resumed_run_downloads_nothing_already_done(tmp_path):
+    bot = FakeBot({"a": png_sticker("a"), "b": png_sticker("b")})
+    stats = run_warmer(bot, str(tmp_path), ["png", "webm"])
+    assert (stats.converted, stats.unsupported, stats.failed) == (2, 2, 0)
+    assert len(bot.timings["download"]) == 2
+
+    bot = FakeBot({"a": png_sticker("a"), "b": png_sticker("b")})
+    stats = run_warmer(bot, str(tmp_path), ["png", "webm"])
+    assert (stats.converted, stats.skipped, stats.unsupported) == (0, 2, 2)
+    assert bot.timings["download"] == []
+
+
+def test_only_formats_get_sticker_can_request_are_offered():
+    parser = build_parser()
+    assert parser.parse_args(["--set", "pack", "--format", "png_sequence"]).formats == ["png_sequence"]
+    for out_format in ("mov", "mpeg"):
+        with pytest.raises(SystemExit):
+            parser.parse_args(["--set", "pack", "--format", out_format])